@@ -1,51 +1,195 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
 import os
-import cv2
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
-import scipy.ndimage as ndimage
+from profiling import profiled
+
+# sklearn is imported only for scaling and PCA, and matplotlib only for
+# colormaps and visualization, so the spectral index path imports quickly
+
+# ENVI "data type" codes
+ENVI_DATA_TYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+    13: np.uint32,
+    14: np.int64,
+    15: np.uint64,
+}
+
+# Raw file extensions that imply a band interleave
+ENVI_INTERLEAVES = {
+    '.bil': 'bil',
+    '.bip': 'bip',
+    '.bsq': 'bsq',
+}
 
 class HyperspectralHeatmapGenerator:
-    def __init__(self):
+    def __init__(self, tissue_classes=None, cache=None, dtype=None, spectral_indices=None):
         """
         Initialize the hyperspectral heatmap generator
+        
+        Parameters:
+        - tissue_classes: Optional list of (label, percentile, colormap) tuples in priority
+          order; a pixel is assigned the first class whose intensity percentile it exceeds
+          (default: tumor > 90th, brain tissue > 40th, vessels > 70th percentile)
+        - cache: Optional pipeline_cache.ArrayCache for intermediate results
+        - dtype: Working float dtype (e.g. np.float32 to halve memory and bandwidth on
+          large cubes); None keeps the default float64 promotion of numpy and sklearn
+        - spectral_indices: Optional spectral_indices.SpectralIndexRegistry
+          (default: a registry with the built-in ndvi and tumor indices)
         """
         # Define custom colormaps for different tissue types
-        self.tumor_cmap = plt.cm.hot
-        self.brain_tissue_cmap = plt.cm.viridis
-        self.vessel_cmap = plt.cm.cool
-        
-    def load_hyperspectral_image(self, file_path):
+        # (matplotlib colormaps or colormap names, resolved when first used)
+        self.tumor_cmap = 'hot'
+        self.brain_tissue_cmap = 'viridis'
+        self.vessel_cmap = 'cool'
+        self.tissue_classes = tissue_classes
+        self.cache = cache
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.spectral_indices = spectral_indices
+        
+        # Colormap lookup tables for the tissue colorizer, rebuilt when the classes change
+        self._tissue_lut_cache = {}
+        
+    @profiled('heatmap.load_hyperspectral_image')
+    def load_hyperspectral_image(self, file_path, mmap=True, bands=None, roi=None):
         """
         Load hyperspectral image data
         
         Parameters:
-        - file_path: Path to the hyperspectral image file
+        - file_path: Path to the hyperspectral image file (.npy, ENVI .hdr/raw, or image)
+        - mmap: Memory-map .npy and ENVI files instead of reading them into memory
+        - bands: Optional band indices (or slice) to select
+        - roi: Optional (row_slice, col_slice) region of interest to select
         
         Returns:
-        - Hyperspectral image as numpy array
+        - Hyperspectral image as numpy array (a lazy memory-mapped view where possible)
         """
         # Detect file extension and load accordingly
-        if file_path.endswith('.npy'):
-            return np.load(file_path)
-        elif file_path.endswith(('.png', '.jpg', '.jpeg', '.tiff')):
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == '.npy':
+            img = np.load(file_path, mmap_mode='r' if mmap else None)
+        elif extension == '.hdr' or extension in ENVI_INTERLEAVES or extension in ('.raw', '.img', '.dat'):
+            img = self.load_envi_image(file_path, mmap=mmap)
+        elif extension in ('.png', '.jpg', '.jpeg', '.tiff'):
             # For demonstration with RGB images
+            import matplotlib.pyplot as plt
             img = plt.imread(file_path)
             # If grayscale, expand to 3D
             if len(img.shape) == 2:
                 img = img[..., np.newaxis]
-            return img
         else:
             raise ValueError(f"Unsupported file format: {file_path}")
-            
-    def normalize_hyperspectral_data(self, hyperspectral_image):
+        
+        # Region and band selection only read the requested part of a memory map
+        if roi is not None:
+            img = img[roi[0], roi[1]]
+        if bands is not None:
+            img = img[:, :, bands]
+        return img
+    
+    def read_envi_header(self, header_path):
+        """
+        Parse an ENVI header file
+        
+        Parameters:
+        - header_path: Path to the .hdr file
+        
+        Returns:
+        - Dictionary of lower-cased header fields
+        """
+        with open(header_path, 'r') as header_file:
+            text = header_file.read()
+        
+        if not text.startswith('ENVI'):
+            raise ValueError(f"Not an ENVI header: {header_path}")
+        
+        header = {}
+        key = None
+        for line in text.splitlines()[1:]:
+            if key is not None:
+                # Continuation of a multi-line {...} value
+                header[key] += ' ' + line.strip()
+                if '}' in line:
+                    key = None
+                continue
+            if '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            name = name.strip().lower()
+            header[name] = value.strip()
+            if value.strip().startswith('{') and '}' not in value:
+                key = name
+        
+        return header
+    
+    def load_envi_image(self, file_path, mmap=True):
+        """
+        Load an ENVI or raw band-interleaved (BIL/BIP/BSQ) hyperspectral cube
+        
+        Parameters:
+        - file_path: Path to the .hdr file or to the raw data file next to it
+        - mmap: Memory-map the raw data instead of reading it into memory
+        
+        Returns:
+        - Hyperspectral image as a (rows, cols, bands) array view
+        """
+        base, extension = os.path.splitext(file_path)
+        if extension.lower() == '.hdr':
+            header_path = file_path
+            data_path = None
+            for candidate in ('', '.raw', '.img', '.dat', '.bil', '.bip', '.bsq'):
+                if os.path.exists(base + candidate):
+                    data_path = base + candidate
+                    break
+            if data_path is None:
+                raise FileNotFoundError(f"No raw data file found for header: {file_path}")
+        else:
+            data_path = file_path
+            header_path = base + '.hdr'
+            if not os.path.exists(header_path):
+                header_path = file_path + '.hdr'
+        
+        header = self.read_envi_header(header_path)
+        rows = int(header['lines'])
+        cols = int(header['samples'])
+        n_bands = int(header['bands'])
+        dtype = np.dtype(ENVI_DATA_TYPES[int(header.get('data type', 4))])
+        if int(header.get('byte order', 0)) == 1:
+            dtype = dtype.newbyteorder('>')
+        offset = int(header.get('header offset', 0))
+        
+        interleave = header.get('interleave', ENVI_INTERLEAVES.get(os.path.splitext(data_path)[1].lower(), 'bsq'))
+        interleave = interleave.strip().lower()
+        if interleave == 'bsq':
+            disk_shape, axes = (n_bands, rows, cols), (1, 2, 0)
+        elif interleave == 'bil':
+            disk_shape, axes = (rows, n_bands, cols), (0, 2, 1)
+        elif interleave == 'bip':
+            disk_shape, axes = (rows, cols, n_bands), (0, 1, 2)
+        else:
+            raise ValueError(f"Unsupported interleave: {interleave}")
+        
+        if mmap:
+            data = np.memmap(data_path, dtype=dtype, mode='r', offset=offset, shape=disk_shape)
+        else:
+            data = np.fromfile(data_path, dtype=dtype, count=int(np.prod(disk_shape)), offset=offset)
+            data = data.reshape(disk_shape)
+        
+        # View as (rows, cols, bands) without copying
+        return np.transpose(data, axes)
+    
+    @profiled('heatmap.normalize_hyperspectral_data')
+    def normalize_hyperspectral_data(self, hyperspectral_image, tile_rows=None, out=None):
         """
         Normalize hyperspectral data across all bands
         
         Parameters:
         - hyperspectral_image: Input hyperspectral image
+        - tile_rows: If set, fit and apply the normalization out-of-core over tiles of this many rows
+        - out: Optional preallocated output array (e.g. a memory map) for the tiled path
         
         Returns:
         - Normalized hyperspectral image
@@ -53,21 +197,115 @@ class HyperspectralHeatmapGenerator:
         # Reshape to 2D for normalization
         orig_shape = hyperspectral_image.shape
         if len(orig_shape) == 3:
-            rows, cols, bands = orig_shape
-            reshaped_img = hyperspectral_image.reshape(rows * cols, bands)
+            if tile_rows is not None:
+                return self._normalize_tiled(hyperspectral_image, tile_rows, out)
             
-            # Normalize each spectral band
-            scaler = StandardScaler()
-            normalized_data = scaler.fit_transform(reshaped_img)
+            def standardize():
+                from sklearn.preprocessing import StandardScaler
+                
+                rows, cols, bands = orig_shape
+                reshaped_img = self._as_working_dtype(hyperspectral_image).reshape(rows * cols, bands)
+                
+                # Normalize each spectral band (StandardScaler preserves float32)
+                scaler = StandardScaler()
+                normalized_data = scaler.fit_transform(reshaped_img)
+                
+                # Reshape back to original dimensions
+                return normalized_data.reshape(orig_shape)
             
-            # Reshape back to original dimensions
-            normalized_img = normalized_data.reshape(orig_shape)
-            return normalized_img
+            return self._cached('normalize', hyperspectral_image, standardize)
         else:
             # Handle 2D images
+            hyperspectral_image = self._as_working_dtype(hyperspectral_image)
             return (hyperspectral_image - hyperspectral_image.min()) / (hyperspectral_image.max() - hyperspectral_image.min())
     
-    def create_spectral_heatmap(self, hyperspectral_image, band_indices=None, enhancement_factor=1.5):
+    def _cached(self, stage, hyperspectral_image, compute_fn, **params):
+        """
+        Run a stage through the pipeline cache, keyed by its input content and parameters
+        
+        Memory-mapped cubes (see load_envi_image) are keyed by their file and
+        layout, so a cache hit never reads the bands the stage does not use.
+        """
+        if self.cache is None:
+            return compute_fn()
+        if self.dtype is not None:
+            params['dtype'] = self.dtype.str
+        key = self.cache.key(self.cache.content_key(hyperspectral_image), stage, **params)
+        return self.cache.get_or_compute(key, compute_fn)
+    
+    def _as_working_dtype(self, array):
+        """
+        Convert an array to the working dtype (no copy if it already has it)
+        """
+        if self.dtype is None:
+            return array
+        return np.asarray(array, dtype=self.dtype)
+    
+    def _row_tiles(self, rows, tile_rows):
+        """
+        Yield row slices covering an image in tiles of tile_rows rows
+        """
+        for start in range(0, rows, tile_rows):
+            yield slice(start, min(start + tile_rows, rows))
+    
+    def _fit_band_statistics(self, hyperspectral_image, tile_rows):
+        """
+        Fit per-band mean and standard deviation in a single pass over row tiles
+        
+        Parameters:
+        - hyperspectral_image: Input hyperspectral image (rows, cols, bands)
+        - tile_rows: Number of rows per tile
+        
+        Returns:
+        - Per-band mean and scale, matching StandardScaler
+        """
+        rows, cols, bands = hyperspectral_image.shape
+        count = 0
+        mean = np.zeros(bands)
+        m2 = np.zeros(bands)
+        
+        for row_slice in self._row_tiles(rows, tile_rows):
+            tile = np.array(hyperspectral_image[row_slice], dtype=np.float64).reshape(-1, bands)
+            n = tile.shape[0]
+            tile_mean = tile.mean(axis=0)
+            tile -= tile_mean
+            tile_m2 = np.einsum('ij,ij->j', tile, tile)
+            
+            # Merge tile statistics into the running totals (Chan et al.)
+            delta = tile_mean - mean
+            total = count + n
+            mean += delta * (n / total)
+            m2 += tile_m2 + delta ** 2 * (count * n / total)
+            count = total
+        
+        scale = np.sqrt(m2 / count)
+        # Constant bands are left unscaled, as StandardScaler does
+        scale[scale == 0] = 1.0
+        return mean, scale
+    
+    def _normalize_tiled(self, hyperspectral_image, tile_rows, out=None):
+        """
+        Standardize a cube tile by tile into a preallocated output
+        """
+        mean, scale = self._fit_band_statistics(hyperspectral_image, tile_rows)
+        
+        if out is None:
+            out = np.empty(hyperspectral_image.shape, dtype=self.dtype or np.float64)
+        # Statistics are fitted in float64 and applied in the output dtype
+        mean = mean.astype(out.dtype)
+        scale = scale.astype(out.dtype)
+        
+        for row_slice in self._row_tiles(hyperspectral_image.shape[0], tile_rows):
+            tile = out[row_slice]
+            tile[...] = hyperspectral_image[row_slice]
+            tile -= mean
+            tile /= scale
+        
+        return out
+    
+    @profiled('heatmap.create_spectral_heatmap')
+    def create_spectral_heatmap(self, hyperspectral_image, band_indices=None, enhancement_factor=1.5, tile_rows=None, out=None,
+                                pca_backend='full', basis=None):
         """
         Create spectral heatmap from hyperspectral image
         
@@ -75,6 +313,12 @@ class HyperspectralHeatmapGenerator:
         - hyperspectral_image: Input hyperspectral image
         - band_indices: Specific spectral bands to use (default: use all)
         - enhancement_factor: Factor to enhance contrast
+        - tile_rows: If set, fit and apply PCA incrementally over tiles of this many rows
+          (or, with a basis, only project tile by tile)
+        - out: Optional preallocated (rows, cols, 3) output array for the tiled path
+        - pca_backend: 'full', 'randomized', 'subsample' or 'covariance' (see spectral_pca);
+          the tiled path fits incrementally and only supports 'full'
+        - basis: Optional previously fitted SpectralBasis; the cube is only projected onto it
         
         Returns:
         - Spectral heatmap
@@ -82,23 +326,47 @@ class HyperspectralHeatmapGenerator:
         if len(hyperspectral_image.shape) < 3:
             raise ValueError("Input must be a 3D hyperspectral image")
             
-        # Use specified bands or all available bands
+        if tile_rows is not None:
+            if basis is None and pca_backend != 'full':
+                raise ValueError(f"PCA backend '{pca_backend}' is not supported with tile_rows; "
+                                 "pass a fitted basis instead")
+            return self._spectral_heatmap_tiled(hyperspectral_image, band_indices, enhancement_factor, tile_rows, out,
+                                                basis)
+            
+        # Use specified bands or all available bands; selecting from a
+        # memory-mapped cube only reads the requested bands from disk
         if band_indices is None:
-            band_indices = range(hyperspectral_image.shape[2])
+            selected_bands = hyperspectral_image
+        else:
+            selected_bands = hyperspectral_image[:, :, band_indices]
+        
+        def fit_pca():
+            selected = self._as_working_dtype(selected_bands)
+            if basis is not None:
+                # Reuse a fitted basis: PCA becomes a single projection
+                return basis.project(selected)
+            if pca_backend != 'full':
+                return self.fit_spectral_basis(selected, method=pca_backend).project(selected)
             
-        # Extract relevant bands
-        selected_bands = hyperspectral_image[:, :, band_indices]
-        
-        # Apply PCA to reduce dimensionality to 3 components for RGB visualization
-        rows, cols, bands = selected_bands.shape
-        reshaped_data = selected_bands.reshape(rows * cols, bands)
-        
-        # Apply PCA for dimensionality reduction
-        pca = PCA(n_components=3)
-        pca_result = pca.fit_transform(reshaped_data)
+            from sklearn.decomposition import PCA
+            
+            # Apply PCA to reduce dimensionality to 3 components for RGB visualization
+            rows, cols, bands = selected.shape
+            reshaped_data = selected.reshape(rows * cols, bands)
+            
+            # Apply PCA for dimensionality reduction (PCA preserves float32)
+            pca = PCA(n_components=3)
+            pca_result = pca.fit_transform(reshaped_data)
+            
+            # Reshape back to image dimensions
+            return pca_result.reshape(rows, cols, 3)
         
-        # Reshape back to image dimensions
-        heatmap = pca_result.reshape(rows, cols, 3)
+        # PCA components are cached independently of the contrast enhancement
+        basis_key = None
+        if basis is not None and self.cache is not None:
+            basis_key = [self.cache.content_key(basis.mean), self.cache.content_key(basis.components)]
+        heatmap = self._cached('pca', hyperspectral_image, fit_pca, band_indices=repr(band_indices),
+                               pca_backend=pca_backend, basis=basis_key)
         
         # Normalize to [0, 1] range
         heatmap = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min())
@@ -108,102 +376,262 @@ class HyperspectralHeatmapGenerator:
         
         return heatmap
     
-    def create_spectral_index_heatmap(self, hyperspectral_image, index_type='ndvi'):
+    @profiled('heatmap.fit_spectral_basis')
+    def fit_spectral_basis(self, hyperspectral_image, band_indices=None, method='covariance', **kwargs):
+        """
+        Fit a 3-component spectral basis that can be saved and reused across scans
+        
+        Parameters:
+        - hyperspectral_image: Input hyperspectral image
+        - band_indices: Specific spectral bands to use (default: use all)
+        - method: PCA backend ('full', 'randomized', 'subsample' or 'covariance')
+        - kwargs: Extra options for spectral_pca.fit_spectral_basis
+        
+        Returns:
+        - spectral_pca.SpectralBasis
+        """
+        from spectral_pca import fit_spectral_basis
+        
+        if band_indices is not None:
+            hyperspectral_image = hyperspectral_image[:, :, band_indices]
+        return fit_spectral_basis(hyperspectral_image, n_components=3, method=method, **kwargs)
+    
+    def _spectral_heatmap_tiled(self, hyperspectral_image, band_indices, enhancement_factor, tile_rows, out=None,
+                                basis=None):
+        """
+        PCA heatmap computed out-of-core: IncrementalPCA is fitted over row tiles
+        (unless a fitted basis is given) and each tile is then projected into a
+        preallocated output
+        """
+        rows, cols = hyperspectral_image.shape[:2]
+        
+        def read_tile(row_slice):
+            tile = hyperspectral_image[row_slice]
+            if band_indices is not None:
+                tile = tile[:, :, band_indices]
+            return self._as_working_dtype(np.asarray(tile))
+        
+        if basis is None:
+            # Fit PCA incrementally, one tile in memory at a time
+            from sklearn.decomposition import IncrementalPCA
+            pca = IncrementalPCA(n_components=3)
+            for row_slice in self._row_tiles(rows, tile_rows):
+                tile = read_tile(row_slice)
+                pca.partial_fit(tile.reshape(-1, tile.shape[2]))
+        
+        if out is None:
+            out = np.empty((rows, cols, 3), dtype=self.dtype or np.float64)
+        
+        # Project tile by tile, tracking the global range for normalization
+        heat_min, heat_max = np.inf, -np.inf
+        for row_slice in self._row_tiles(rows, tile_rows):
+            tile = out[row_slice]
+            if basis is not None:
+                basis.project(read_tile(row_slice), out=tile)
+            else:
+                selected = read_tile(row_slice)
+                tile[...] = pca.transform(selected.reshape(-1, selected.shape[2])).reshape(-1, cols, 3)
+            # Range of the stored values, so rounding to the output dtype cannot leave them below 0
+            heat_min = min(heat_min, tile.min())
+            heat_max = max(heat_max, tile.max())
+        
+        # Normalize to [0, 1] range and enhance contrast in place
+        for row_slice in self._row_tiles(rows, tile_rows):
+            tile = out[row_slice]
+            tile -= heat_min
+            tile /= (heat_max - heat_min)
+            np.power(tile, 1.0/enhancement_factor, out=tile)
+        
+        return out
+    
+    @profiled('heatmap.create_spectral_index_heatmap')
+    def create_spectral_index_heatmap(self, hyperspectral_image, index_type='ndvi', tile_rows=None):
         """
         Create heatmap based on spectral indices
         
         Parameters:
         - hyperspectral_image: Input hyperspectral image
-        - index_type: Type of spectral index to use
+        - index_type: Name of a registered spectral index (see register_spectral_index)
+        - tile_rows: Rows evaluated per tile (default: about 64k pixels per tile)
         
         Returns:
         - Spectral index heatmap
         """
-        # Ensure we have enough bands
-        if hyperspectral_image.shape[2] < 4:
-            raise ValueError(f"Not enough spectral bands for index: {index_type}")
-            
-        # Create different indices based on type
-        if index_type == 'ndvi':
-            # Example: Near-infrared and Red bands (adjust indices as needed)
-            nir_band = hyperspectral_image[:, :, 3]  # Example NIR band
-            red_band = hyperspectral_image[:, :, 2]  # Example Red band
-            
-            # Avoid division by zero
-            denominator = nir_band + red_band
-            denominator[denominator == 0] = 1e-10
-            
-            index_map = (nir_band - red_band) / denominator
-            
-        elif index_type == 'tumor':
-            # Example: Custom index for tumor detection
-            # Replace with actual spectral bands relevant for tumor detection
-            band1 = hyperspectral_image[:, :, 0]
-            band2 = hyperspectral_image[:, :, 1]
-            band3 = hyperspectral_image[:, :, 2]
-            
-            # Example formula (to be replaced with actual tumor detection formula)
-            index_map = (band1 + band2) / (band3 + 1e-10)
-            
-        else:
-            raise ValueError(f"Unsupported index type: {index_type}")
-            
-        # Normalize the index map to [0, 1]
-        index_map = (index_map - index_map.min()) / (index_map.max() - index_map.min() + 1e-10)
+        return self.create_spectral_index_stack(hyperspectral_image, [index_type], tile_rows=tile_rows)[:, :, 0]
+    
+    @profiled('heatmap.create_spectral_index_stack')
+    def create_spectral_index_stack(self, hyperspectral_image, index_types, tile_rows=None, out=None):
+        """
+        Evaluate several spectral indices in a single pass over the cube
+        
+        Raises ValueError if the cube has fewer bands than one of the indices uses.
         
-        return index_map
+        Parameters:
+        - hyperspectral_image: Input hyperspectral image
+        - index_types: Names of registered spectral indices
+        - tile_rows: Rows evaluated per tile (default: about 64k pixels per tile)
+        - out: Optional preallocated (rows, cols, len(index_types)) output array
         
-    def apply_tissue_specific_heatmap(self, hyperspectral_image, tissue_mask=None):
+        Returns:
+        - Index maps normalized to [0, 1], stacked along the last axis
+        """
+        # Formulas are compiled once into ufunc chains over preallocated temporaries
+        index_maps = self.get_spectral_indices().evaluate(hyperspectral_image, index_types, out=out,
+                                                          dtype=self.dtype, tile_rows=tile_rows)
+        
+        # Normalize each index map to [0, 1] in place (per-map reductions are much
+        # faster than reducing the interleaved stack over its first two axes)
+        for i in range(index_maps.shape[2]):
+            index_map = index_maps[:, :, i]
+            index_min = index_map.min()
+            index_range = index_map.max() - index_min + 1e-10
+            index_map -= index_min
+            index_map /= index_range
+        
+        return index_maps
+    
+    def get_spectral_indices(self):
+        """
+        Spectral index registry of this generator (created on first use)
+        """
+        if self.spectral_indices is None:
+            from spectral_indices import SpectralIndexRegistry
+            self.spectral_indices = SpectralIndexRegistry()
+        return self.spectral_indices
+    
+    def register_spectral_index(self, name, expression):
+        """
+        Register a spectral index as a band-arithmetic expression
+        
+        Parameters:
+        - name: Index name used as index_type
+        - expression: Expression over bands b0, b1, ..., e.g. '(b3 - b2) / (b3 + b2)';
+          division is safe (zero denominators are replaced with 1e-10)
+        """
+        self.get_spectral_indices().register(name, expression)
+        
+    @profiled('heatmap.apply_tissue_specific_heatmap')
+    def apply_tissue_specific_heatmap(self, hyperspectral_image, tissue_mask=None, as_uint8=False, out=None):
         """
         Apply tissue-specific colormaps for different regions
         
         Parameters:
         - hyperspectral_image: Input hyperspectral image
         - tissue_mask: Optional segmentation mask (if None, will attempt to segment)
+        - as_uint8: Return an 8-bit RGB image instead of floats in [0, 1]
+        - out: Optional preallocated (rows, cols, 3) output array
         
         Returns:
         - Tissue-colored heatmap
         """
+        # Intensity projection, used for both segmentation and coloring
+        intensity = np.mean(hyperspectral_image, axis=2, dtype=self.dtype)
+        
+        return self.tissue_heatmap_from_intensity(intensity, tissue_mask, as_uint8, out)
+    
+    def tissue_heatmap_from_intensity(self, intensity, tissue_mask=None, as_uint8=False, out=None):
+        """
+        Tissue-colored heatmap from a precomputed intensity projection
+        
+        Parameters:
+        - intensity: Mean intensity over bands (rows, cols)
+        - tissue_mask: Optional segmentation mask (if None, will attempt to segment)
+        - as_uint8: Return an 8-bit RGB image instead of floats in [0, 1]
+        - out: Optional preallocated (rows, cols, 3) output array (any dtype or memory layout)
+        
+        Returns:
+        - Tissue-colored heatmap
+        """
+        if out is not None and out.shape != intensity.shape + (3,):
+            raise ValueError(f"Output shape {out.shape} does not match {intensity.shape + (3,)}")
+        tissue_classes = self.get_tissue_classes()
+        
         # If no mask provided, attempt to segment the image
         if tissue_mask is None:
-            # Simple clustering-based segmentation example
-            # In practice, use more sophisticated segmentation methods
-            avg_intensity = np.mean(hyperspectral_image, axis=2)
-            
             # Simple thresholding for demonstration
             # Replace with actual tissue segmentation algorithm
-            tumor_mask = avg_intensity > np.percentile(avg_intensity, 90)
-            brain_mask = (avg_intensity > np.percentile(avg_intensity, 40)) & ~tumor_mask
-            vessel_mask = (avg_intensity > np.percentile(avg_intensity, 70)) & ~tumor_mask & ~brain_mask
-            
-            tissue_mask = np.zeros_like(avg_intensity)
-            tissue_mask[tumor_mask] = 1   # Tumor
-            tissue_mask[brain_mask] = 2   # Brain tissue
-            tissue_mask[vessel_mask] = 3  # Vessels
-        
-        # Create RGB heatmap
-        heatmap = np.zeros((hyperspectral_image.shape[0], hyperspectral_image.shape[1], 3))
+            classes = self._classify_by_percentile(intensity, tissue_classes)
+        else:
+            classes = np.zeros(intensity.shape, dtype=np.intp)
+            for class_idx, (label, _, _) in enumerate(tissue_classes, start=1):
+                classes[tissue_mask == label] = class_idx
+        
+        # Each class owns a 256-entry block of the lookup table; block 0 is background
+        color_idx = intensity * 256
+        np.clip(color_idx, 0, 255, out=color_idx)
+        lut_idx = color_idx.astype(np.intp)
+        classes *= 256
+        lut_idx += classes
+        
+        lut = self._tissue_lut(tissue_classes, as_uint8)
+        if out is None:
+            out = np.empty(intensity.shape + (3,), dtype=lut.dtype)
+        if out.dtype == lut.dtype and out.flags.c_contiguous:
+            np.take(lut, lut_idx.reshape(-1), axis=0, out=out.reshape(-1, 3))
+        else:
+            # Reshaping any other output would copy it, and take would fill the copy
+            out[...] = np.take(lut, lut_idx, axis=0)
         
-        # Apply spectral index or intensity for each tissue type
-        intensity = np.mean(hyperspectral_image, axis=2)
+        return out
+    
+    def get_tissue_classes(self):
+        """
+        Tissue classes as (label, percentile, colormap) tuples in priority order
+        """
+        if self.tissue_classes is not None:
+            return self.tissue_classes
+        return [
+            (1, 90, self.tumor_cmap),         # Tumor
+            (2, 40, self.brain_tissue_cmap),  # Brain tissue
+            (3, 70, self.vessel_cmap),        # Vessels
+        ]
+    
+    def _classify_by_percentile(self, intensity, tissue_classes):
+        """
+        Assign each pixel the first class (1-based) whose percentile threshold it exceeds
+        """
+        # All thresholds come from a single partition of the intensities
+        thresholds = np.atleast_1d(np.percentile(intensity, [percentile for _, percentile, _ in tissue_classes]))
+        order = np.argsort(thresholds, kind='stable')
         
-        # Apply different colormaps for different tissues
-        tumor_regions = tissue_mask == 1
-        brain_regions = tissue_mask == 2
-        vessel_regions = tissue_mask == 3
+        # A pixel exceeding k of the sorted thresholds exceeds exactly the classes order[:k]
+        n_exceeded = np.searchsorted(thresholds[order], intensity, side='left')
         
-        # Apply colormaps
-        if np.any(tumor_regions):
-            heatmap[tumor_regions] = self.tumor_cmap(intensity[tumor_regions])[:, :3]
+        # Resolve each count to the highest-priority exceeded class (0 = background)
+        class_for_count = np.zeros(len(tissue_classes) + 1, dtype=np.intp)
+        for count in range(1, len(tissue_classes) + 1):
+            class_for_count[count] = min(order[:count]) + 1
         
-        if np.any(brain_regions):
-            heatmap[brain_regions] = self.brain_tissue_cmap(intensity[brain_regions])[:, :3]
-            
-        if np.any(vessel_regions):
-            heatmap[vessel_regions] = self.vessel_cmap(intensity[vessel_regions])[:, :3]
-            
-        return heatmap
+        return class_for_count[n_exceeded]
     
+    def _tissue_lut(self, tissue_classes, as_uint8):
+        """
+        Stacked 256-entry RGB lookup tables for the background and each tissue colormap
+        """
+        cmaps = tuple(cmap for _, _, cmap in tissue_classes)
+        lut_key = (as_uint8, self.dtype)
+        cached = self._tissue_lut_cache.get(lut_key)
+        if cached is not None and len(cached[0]) == len(cmaps) and all(
+                a is b or (isinstance(a, str) and a == b) for a, b in zip(cached[0], cmaps)):
+            return cached[1]
+        
+        import matplotlib
+        
+        # Sample each colormap at the centre of its 256 bins, as matplotlib maps floats
+        samples = (np.arange(256) + 0.5) / 256
+        lut = np.zeros(((len(cmaps) + 1) * 256, 3))
+        for class_idx, cmap in enumerate(cmaps, start=1):
+            if isinstance(cmap, str):
+                cmap = matplotlib.colormaps[cmap]
+            lut[class_idx * 256:(class_idx + 1) * 256] = cmap(samples)[:, :3]
+        if as_uint8:
+            lut = (lut * 255).astype(np.uint8)
+        elif self.dtype is not None:
+            lut = lut.astype(self.dtype)
+        
+        self._tissue_lut_cache[lut_key] = (cmaps, lut)
+        return lut
+        
     def visualize_heatmaps(self, original_image, heatmaps, titles):
         """
         Visualize original image and various heatmaps
@@ -213,6 +641,8 @@ class HyperspectralHeatmapGenerator:
         - heatmaps: List of generated heatmaps
         - titles: List of titles for each heatmap
         """
+        import matplotlib.pyplot as plt
+        
         n_plots = len(heatmaps) + 1
         plt.figure(figsize=(4*n_plots, 4))
         
@@ -238,7 +668,8 @@ class HyperspectralHeatmapGenerator:
         plt.tight_layout()
         plt.show()
         
-    def save_heatmaps(self, output_dir, heatmaps, names):
+    @profiled('heatmap.save_heatmaps')
+    def save_heatmaps(self, output_dir, heatmaps, names, writer=None):
         """
         Save generated heatmaps to disk
         
@@ -246,24 +677,23 @@ class HyperspectralHeatmapGenerator:
         - output_dir: Directory to save heatmaps
         - heatmaps: List of generated heatmaps
         - names: List of filenames for each heatmap
+        - writer: Optional HeatmapWriter to share across calls (default: a new one per call)
         """
-        os.makedirs(output_dir, exist_ok=True)
-        
-        for heatmap, name in zip(heatmaps, names):
-            output_path = os.path.join(output_dir, name)
-            
-            # Normalize to 0-255 range for saving
-            if len(heatmap.shape) == 2:
-                # For 2D heatmaps, apply colormap
-                colored_heatmap = plt.cm.jet(heatmap)
-                heatmap_to_save = (colored_heatmap[:, :, :3] * 255).astype(np.uint8)
-            else:
-                # For RGB heatmaps
-                heatmap_to_save = (heatmap * 255).astype(np.uint8)
-                
-            # Save using matplotlib (supports various formats)
-            plt.imsave(output_path, heatmap_to_save)
-            print(f"Saved heatmap to {output_path}")
+        from heatmap_writer import HeatmapWriter
+        
+        own_writer = writer is None
+        if own_writer:
+            writer = HeatmapWriter(max_workers=max(1, len(heatmaps)))
+        
+        try:
+            # 2D heatmaps get the jet colormap; files are encoded and written in parallel
+            futures = writer.write_many(output_dir, heatmaps, names)
+            for future in futures:
+                output_path = future.result()
+                print(f"Saved heatmap to {output_path}")
+        finally:
+            if own_writer:
+                writer.close()
 
 def main():
     # Initialize heatmap generator
@@ -0,0 +1,174 @@
+import numpy as np
+import cv2
+from profiling import profiled
+
+# cv2.warpAffine handles at most this many channels per call
+_WARP_MAX_CHANNELS = 128
+
+
+def rotation_matrix(angle, rows, cols):
+    """
+    Affine matrix rotating a (rows, cols) image about its centre, as ndimage.rotate does
+
+    Parameters:
+    - angle: Rotation angle in degrees (counter-clockwise)
+    - rows, cols: Image size
+
+    Returns:
+    - 2x3 float64 affine matrix for cv2.warpAffine
+    """
+    return cv2.getRotationMatrix2D(((cols - 1) / 2.0, (rows - 1) / 2.0), angle, 1.0)
+
+
+def warp_image(image, matrix, out=None, interpolation=cv2.INTER_LINEAR):
+    """
+    Apply an affine warp to an image with any number of channels (zero border)
+
+    Parameters:
+    - image: Input (rows, cols) or (rows, cols, channels) array
+    - matrix: 2x3 affine matrix
+    - out: Optional preallocated output of the same shape and dtype
+    - interpolation: OpenCV interpolation flag
+
+    Returns:
+    - Warped image
+    """
+    rows, cols = image.shape[:2]
+    if out is None:
+        out = np.empty_like(image)
+
+    if image.ndim == 2 or image.shape[2] <= _WARP_MAX_CHANNELS:
+        warped = cv2.warpAffine(image, matrix, (cols, rows), dst=out, flags=interpolation,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        if warped is not out:
+            # OpenCV drops a trailing channel axis of size 1
+            out[...] = warped.reshape(out.shape)
+        return out
+
+    for start in range(0, image.shape[2], _WARP_MAX_CHANNELS):
+        chunk = np.ascontiguousarray(image[:, :, start:start + _WARP_MAX_CHANNELS])
+        warped = cv2.warpAffine(chunk, matrix, (cols, rows), flags=interpolation,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        out[:, :, start:start + _WARP_MAX_CHANNELS] = warped.reshape(chunk.shape)
+    return out
+
+
+class SyntheticAugmenter:
+    def __init__(self, image, mask, n_samples=5, batch_size=4, noise_std=0.1, max_angle=20,
+                 include_original=True, seed=None):
+        """
+        Batched generator of noised and rotated copies of one image/mask pair
+
+        Samples are produced a batch at a time, so thousands of augmented samples
+        never have to be held in memory. Each batch is seeded from (seed, batch
+        index), so batches can be built in any order and in parallel.
+
+        Parameters:
+        - image: Normalized input image (rows, cols, channels) in [0, 1]
+        - mask: Mask of the image (any 2D size; rotated with the image)
+        - n_samples: Number of augmented samples
+        - batch_size: Samples per batch
+        - noise_std: Standard deviation of the additive Gaussian noise
+        - max_angle: Rotations are drawn from the integers in [-max_angle, max_angle)
+        - include_original: Prepend the unmodified pair as the first sample
+        - seed: Random seed (default: a fresh random seed)
+        """
+        self.image = np.asarray(image, dtype=np.float32)
+        self.mask = np.asarray(mask, dtype=np.uint8)
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.noise_std = noise_std
+        self.max_angle = max_angle
+        self.include_original = include_original
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+    @property
+    def total_samples(self):
+        return self.n_samples + (1 if self.include_original else 0)
+
+    def __len__(self):
+        return -(-self.total_samples // self.batch_size)
+
+    @profiled('train.augmentation')
+    def batch(self, index):
+        """
+        Build one batch
+
+        Parameters:
+        - index: Batch index in [0, len(self))
+
+        Returns:
+        - Tuple of float32 images (n, rows, cols, channels) and boolean masks (n, mask_rows, mask_cols)
+        """
+        start = index * self.batch_size
+        stop = min(start + self.batch_size, self.total_samples)
+        n = stop - start
+
+        images = np.empty((n,) + self.image.shape, dtype=np.float32)
+        masks = np.empty((n,) + self.mask.shape, dtype=np.uint8)
+        rng = np.random.default_rng([self.seed, index])
+
+        # Noise for the whole batch in one call; each noisy image is then warped
+        # into its output slot
+        first = 0
+        if self.include_original and start == 0:
+            images[0] = self.image
+            masks[0] = self.mask
+            first = 1
+        noisy = rng.standard_normal((n - first,) + self.image.shape, dtype=np.float32)
+        noisy *= self.noise_std
+        noisy += self.image
+        np.clip(noisy, 0, 1, out=noisy)
+        angles = rng.integers(-self.max_angle, self.max_angle, size=n - first)
+
+        image_rows, image_cols = self.image.shape[:2]
+        mask_rows, mask_cols = self.mask.shape[:2]
+        for i, angle in enumerate(angles, start=first):
+            warp_image(noisy[i - first], rotation_matrix(angle, image_rows, image_cols), out=images[i])
+            # Linear interpolation of 0/1 uint8 rounds, i.e. thresholds at 0.5
+            warp_image(self.mask, rotation_matrix(angle, mask_rows, mask_cols), out=masks[i])
+
+        return images, masks.view(bool)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.batch(index)
+
+    def as_dataset(self, label_fn=None, parallel_calls=None, repeat=False):
+        """
+        tf.data pipeline building batches in parallel with training
+
+        Parameters:
+        - label_fn: Optional callable mapping a boolean mask batch to training targets
+          (default: the masks as float32)
+        - parallel_calls: Batches built concurrently (default: tf.data.AUTOTUNE)
+        - repeat: Repeat the batches indefinitely (for steps_per_epoch training)
+
+        Returns:
+        - tf.data.Dataset of (images, targets) batches, prefetched
+        """
+        import tensorflow as tf
+
+        if label_fn is None:
+            def label_fn(masks):
+                return masks.astype(np.float32)
+
+        # Output signature from a probe batch, so Keras sees static shapes
+        probe_images, probe_masks = self.batch(0)
+        probe_labels = label_fn(probe_masks)
+
+        def make_batch(index):
+            images, masks = self.batch(int(index))
+            return images, np.asarray(label_fn(masks), dtype=np.float32)
+
+        def load(index):
+            images, labels = tf.numpy_function(make_batch, [index], [tf.float32, tf.float32])
+            images.set_shape((None,) + probe_images.shape[1:])
+            labels.set_shape((None,) + probe_labels.shape[1:])
+            return images, labels
+
+        dataset = tf.data.Dataset.range(len(self))
+        if repeat:
+            dataset = dataset.repeat()
+        return dataset.map(load, num_parallel_calls=parallel_calls or tf.data.AUTOTUNE,
+                           deterministic=True).prefetch(tf.data.AUTOTUNE)
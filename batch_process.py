@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import cv2
+import numpy as np
+
+# Scan file extensions picked up when walking a dataset directory
+SCAN_EXTENSIONS = ('.npy', '.hdr', '.png', '.jpg', '.jpeg', '.tiff')
+
+# Written into each scan's output directory once all of its outputs exist
+DONE_MARKER = 'timings.json'
+
+# Per-worker state, set up by _init_worker
+_worker_state = {}
+
+
+def find_scans(input_dir, extensions=SCAN_EXTENSIONS, exclude_dir=None):
+    """
+    Walk a dataset directory (e.g. campaign/patient/image) for scan files
+
+    Parameters:
+    - input_dir: Root of the dataset
+    - extensions: File extensions treated as scans
+    - exclude_dir: Directory not to descend into (e.g. an output directory inside the dataset)
+
+    Returns:
+    - Sorted list of scan file paths
+    """
+    exclude_dir = os.path.realpath(exclude_dir) if exclude_dir is not None else None
+    scans = []
+    for root, dirs, files in os.walk(input_dir):
+        if exclude_dir is not None:
+            dirs[:] = [name for name in dirs if os.path.realpath(os.path.join(root, name)) != exclude_dir]
+        for name in files:
+            if name.lower().endswith(extensions):
+                scans.append(os.path.join(root, name))
+    return sorted(scans)
+
+
+def scan_output_dir(scan_path, input_dir, output_dir):
+    """
+    Output directory for a scan, mirroring its place in the dataset layout
+
+    The directory is named after the whole file name, extension included, so
+    scans that differ only in their extension (a.npy, a.png) do not share outputs.
+    """
+    return os.path.join(output_dir, os.path.relpath(scan_path, input_dir))
+
+
+def is_completed(scan_out_dir):
+    """
+    Whether a scan's outputs were fully written by an earlier run
+    """
+    return os.path.exists(os.path.join(scan_out_dir, DONE_MARKER))
+
+
+def _init_worker(tf_threads, model_cache_dir, skull_model=None):
+    """
+    Set up a worker process: headless plotting, a bounded TensorFlow thread budget
+    and, if given, the exported skull model loaded and warmed up once
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    if tf_threads:
+        os.environ['OMP_NUM_THREADS'] = str(tf_threads)
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(tf_threads)
+        os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+
+    import tensorflow as tf
+    if tf_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from model_registry import ModelRegistry
+    from heatmap_writer import HeatmapWriter
+    _worker_state['model_registry'] = ModelRegistry(cache_dir=model_cache_dir)
+    _worker_state['heatmap_writer'] = HeatmapWriter(max_workers=4)
+    if skull_model:
+        from skull_model_artifact import load_skull_model
+        _worker_state['skull_model'] = load_skull_model(skull_model, warm=True)
+
+
+def process_scan(scan_path, scan_out_dir):
+    """
+    Run skull removal and all heatmap generators on one scan
+
+    Parameters:
+    - scan_path: Path to the scan file
+    - scan_out_dir: Directory for this scan's outputs
+
+    Returns:
+    - Dictionary of per-stage timings in seconds
+    """
+    from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+    from skullremoval import skull_removal_with_gradcam
+
+    timings = {}
+    heatmap_gen = HyperspectralHeatmapGenerator()
+
+    start = time.perf_counter()
+    image = np.asarray(heatmap_gen.load_hyperspectral_image(scan_path), dtype=np.float64)
+    # Normalize image and ensure a 3D array, as skullremoval.main does
+    image = (image - image.min()) / (image.max() - image.min())
+    if len(image.shape) == 2:
+        image = image[..., np.newaxis]
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    brain_only, brain_mask, gradcam_heatmap, _ = skull_removal_with_gradcam(
+        image, pretrained_model=_worker_state.get('skull_model'), model_registry=_worker_state.get('model_registry')
+    )
+    timings['skull_removal'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    normalized_image = heatmap_gen.normalize_hyperspectral_data(image)
+    timings['normalize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    spectral_heatmap = heatmap_gen.create_spectral_heatmap(normalized_image)
+    timings['spectral_heatmap'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        spectral_index_map = heatmap_gen.create_spectral_index_heatmap(normalized_image, 'tumor')
+    except ValueError:
+        # Fallback for images with fewer bands
+        spectral_index_map = np.mean(normalized_image, axis=2)
+    timings['spectral_index'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tissue_heatmap = heatmap_gen.apply_tissue_specific_heatmap(normalized_image)
+    timings['tissue_heatmap'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(scan_out_dir, exist_ok=True)
+    np.save(os.path.join(scan_out_dir, 'brain_only.npy'), brain_only)
+    cv2.imwrite(os.path.join(scan_out_dir, 'brain_mask.png'), brain_mask.astype(np.uint8) * 255)
+    heatmap_gen.save_heatmaps(
+        scan_out_dir,
+        [gradcam_heatmap, spectral_heatmap, spectral_index_map, tissue_heatmap],
+        ["gradcam.png", "pca_visualization.png", "spectral_index.png", "tissue_specific.png"],
+        writer=_worker_state.get('heatmap_writer')
+    )
+    timings['save'] = time.perf_counter() - start
+
+    # The marker is written last so an interrupted scan is redone on resume
+    with open(os.path.join(scan_out_dir, DONE_MARKER), 'w') as marker:
+        json.dump(timings, marker, indent=2)
+
+    return timings
+
+
+def _run_scan(scan_path, scan_out_dir):
+    """
+    Worker entry point: process one scan and report its status and timings
+    """
+    record = {'scan': scan_path, 'output_dir': scan_out_dir, 'pid': os.getpid()}
+    start = time.perf_counter()
+    try:
+        record['timings'] = process_scan(scan_path, scan_out_dir)
+        record['status'] = 'ok'
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+        record['traceback'] = traceback.format_exc()
+    record['total'] = time.perf_counter() - start
+    return record
+
+
+def run_batch(input_dir, output_dir, workers=None, tf_threads=1, resume=True, model_cache_dir=None, skull_model=None):
+    """
+    Process every scan under a dataset directory in parallel
+
+    Parameters:
+    - input_dir: Root of the dataset
+    - output_dir: Root of the outputs (mirrors the dataset layout)
+    - workers: Number of worker processes (default: CPU count // tf_threads)
+    - tf_threads: TensorFlow intra-op threads per worker
+    - resume: Skip scans whose outputs were already completed
+    - model_cache_dir: Directory for trained models shared by workers (default: <output_dir>/model_cache)
+    - skull_model: Optional exported skull model artifact used for every scan instead of training
+
+    Returns:
+    - List of manifest records for the scans processed in this run
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // max(1, tf_threads))
+    if model_cache_dir is None:
+        model_cache_dir = os.path.join(output_dir, 'model_cache')
+    if os.path.realpath(output_dir) == os.path.realpath(input_dir):
+        raise ValueError("The output directory must differ from the dataset directory")
+
+    jobs = []
+    # Outputs written inside the dataset are not scans
+    for scan_path in find_scans(input_dir, exclude_dir=output_dir):
+        scan_out_dir = scan_output_dir(scan_path, input_dir, output_dir)
+        if resume and is_completed(scan_out_dir):
+            print(f"Skipping completed scan {scan_path}")
+            continue
+        jobs.append((scan_path, scan_out_dir))
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'manifest.jsonl')
+    records = []
+
+    # TensorFlow is not fork-safe, so workers are spawned
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(tf_threads, model_cache_dir, skull_model)) as pool:
+        futures = [pool.submit(_run_scan, scan_path, scan_out_dir) for scan_path, scan_out_dir in jobs]
+        with open(manifest_path, 'a') as manifest:
+            for future in as_completed(futures):
+                record = future.result()
+                records.append(record)
+                manifest.write(json.dumps({k: v for k, v in record.items() if k != 'traceback'}) + '\n')
+                manifest.flush()
+                if record['status'] == 'ok':
+                    print(f"Processed {record['scan']} in {record['total']:.2f}s")
+                else:
+                    print(f"Failed {record['scan']}: {record['error']}")
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run skull removal and heatmap generation over a directory of scans")
+    parser.add_argument('input_dir', help="Dataset root (e.g. campaign/patient/image layout)")
+    parser.add_argument('output_dir', help="Directory for outputs and the timing manifest")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--tf-threads', type=int, default=1, help="TensorFlow intra-op threads per worker")
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help="Reprocess scans that already have outputs")
+    parser.add_argument('--model-cache-dir', default=None, help="Directory for trained models shared by workers")
+    parser.add_argument('--skull-model', default=None, help="Exported skull model artifact (see export_skull_model)")
+    args = parser.parse_args(argv)
+
+    records = run_batch(args.input_dir, args.output_dir, workers=args.workers, tf_threads=args.tf_threads,
+                        resume=args.resume, model_cache_dir=args.model_cache_dir, skull_model=args.skull_model)
+    failed = sum(record['status'] != 'ok' for record in records)
+    print(f"Processed {len(records) - failed} scans, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
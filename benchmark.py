@@ -0,0 +1,644 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Image sizes and band counts per preset
+PRESETS = {
+    'quick': {'sizes': [256, 512], 'bands': [3, 30]},
+    'full': {'sizes': [256, 512, 1024, 2048], 'bands': [3, 10, 30, 100, 300]},
+}
+
+
+def synthetic_hyperspectral_cube(size, bands, seed=0):
+    """
+    Seeded synthetic hyperspectral cube with tumor- and vessel-like structure
+
+    Parameters:
+    - size: Number of rows and columns
+    - bands: Number of spectral bands
+    - seed: Random seed
+
+    Returns:
+    - Cube of shape (size, size, bands) in [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    cube = rng.random((size, size, bands))
+
+    x, y = np.mgrid[0:size, 0:size] * (256.0 / size)
+    radius = np.sqrt((x - 128) ** 2 + (y - 128) ** 2)
+
+    # Same structures as the HyperspectralHeatmapGenerator demo data
+    structures = [
+        np.exp(-(radius - 50) ** 2 / 1000),
+        (np.sin(x / 10) * np.cos(y / 10) + 1) / 2,
+        np.exp(-(radius - 80) ** 2 / 2000),
+    ]
+    for band in range(min(bands, len(structures))):
+        cube[:, :, band] = structures[band]
+    return cube
+
+
+def synthetic_mri_image(size, bands, seed=0):
+    """
+    Seeded synthetic brain scan with a bright skull ring around a textured brain
+
+    Parameters:
+    - size: Number of rows and columns
+    - bands: Number of spectral bands
+    - seed: Random seed
+
+    Returns:
+    - Image of shape (size, size, bands) in [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    x, y = np.mgrid[0:size, 0:size] / size
+    radius = np.sqrt((x - 0.5) ** 2 + ((y - 0.5) * 1.2) ** 2)
+
+    brain = np.where(radius < 0.33, 0.55 + 0.15 * np.sin(x * 40) * np.cos(y * 30), 0.0)
+    skull = np.exp(-((radius - 0.38) / 0.02) ** 2)
+    base = np.clip(brain + skull, 0, 1)
+
+    image = base[..., np.newaxis] * rng.uniform(0.8, 1.0, bands) + 0.05 * rng.random((size, size, bands))
+    return np.clip(image, 0, 1)
+
+
+def _heatmap_case(method):
+    def setup(size, bands):
+        from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+        heatmap_gen = HyperspectralHeatmapGenerator()
+        cube = synthetic_hyperspectral_cube(size, bands)
+        if method != 'normalize_hyperspectral_data':
+            cube = heatmap_gen.normalize_hyperspectral_data(cube)
+        return heatmap_gen, cube
+
+    def run(state):
+        heatmap_gen, cube = state
+        if method == 'create_spectral_index_heatmap':
+            return heatmap_gen.create_spectral_index_heatmap(cube, 'tumor')
+        if method == 'create_spectral_index_stack':
+            return heatmap_gen.create_spectral_index_stack(cube, ['ndvi', 'tumor'])
+        return getattr(heatmap_gen, method)(cube)
+
+    return setup, run
+
+
+def _pca_backend_case(pca_backend):
+    """
+    Build setup/run functions timing create_spectral_heatmap with a PCA backend
+    ('basis' times the projection onto a basis fitted during setup)
+    """
+    def setup(size, bands):
+        heatmap_gen, cube = _heatmap_case('create_spectral_heatmap')[0](size, bands)
+        basis = heatmap_gen.fit_spectral_basis(cube) if pca_backend == 'basis' else None
+        return heatmap_gen, cube, basis
+
+    def run(state):
+        heatmap_gen, cube, basis = state
+        if basis is not None:
+            return heatmap_gen.create_spectral_heatmap(cube, basis=basis)
+        return heatmap_gen.create_spectral_heatmap(cube, pca_backend=pca_backend)
+
+    return setup, run
+
+
+def _save_heatmaps_setup(size, bands):
+    from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+    heatmap_gen = HyperspectralHeatmapGenerator()
+    cube = heatmap_gen.normalize_hyperspectral_data(synthetic_hyperspectral_cube(size, max(bands, 4)))
+    heatmaps = [
+        heatmap_gen.create_spectral_heatmap(cube),
+        heatmap_gen.create_spectral_index_heatmap(cube, 'tumor'),
+        heatmap_gen.apply_tissue_specific_heatmap(cube),
+    ]
+    return heatmap_gen, heatmaps, tempfile.mkdtemp(prefix='heatmap_bench_')
+
+
+def _save_heatmaps_run(state):
+    heatmap_gen, heatmaps, output_dir = state
+    heatmap_gen.save_heatmaps(output_dir, heatmaps, ["pca.png", "index.png", "tissue.png"])
+
+
+def _gradcam_setup(size, bands):
+    import skullremoval
+    image = synthetic_mri_image(size, bands)
+    cnn_input, _ = skullremoval.prepare_cnn_input(image)
+    return skullremoval, skullremoval.create_simple_cnn(cnn_input.shape[1:]), cnn_input
+
+
+def _gradcam_run(state):
+    skullremoval, model, cnn_input = state
+    return skullremoval.generate_gradcam(model, cnn_input, "final_conv", class_idx=1)
+
+
+def _gradcam_pool_setup(size, bands):
+    from gradcam_pool import GradCAMPool
+    skullremoval, model, cnn_input = _gradcam_setup(size, bands)
+    pool = GradCAMPool(configure_threads=False)
+    # Clone the replicas and trace their Grad-CAM functions before timing
+    [future.result() for future in [pool.submit(model, cnn_input) for _ in range(4 * pool.replicas)]]
+    return pool, model, cnn_input
+
+
+def _gradcam_pool_run(state):
+    # 32 concurrent requests, as from several scans at once
+    pool, model, cnn_input = state
+    return [future.result() for future in [pool.submit(model, cnn_input) for _ in range(32)]]
+
+
+def _augmentation_setup(size, bands):
+    from augmentation import SyntheticAugmenter
+    import skullremoval
+    cnn_input, avg_intensity = skullremoval.prepare_cnn_input(synthetic_mri_image(size, bands))
+    return SyntheticAugmenter(cnn_input[0], skullremoval.traditional_brain_mask(avg_intensity),
+                              n_samples=64, batch_size=16, seed=0)
+
+
+def _augmentation_run(augmenter):
+    for _ in augmenter:
+        pass
+
+
+def _apply_mask_setup(size, bands):
+    import skullremoval
+    image = synthetic_mri_image(size, bands)
+    return skullremoval, image, skullremoval.traditional_brain_mask(np.mean(image, axis=-1))
+
+
+def _apply_mask_run(state):
+    skullremoval, image, mask = state
+    return skullremoval.apply_brain_mask(image, mask)
+
+
+def _session_setup(size, bands):
+    from heatmap_session import HeatmapSession
+    session = HeatmapSession()
+    frame = synthetic_hyperspectral_cube(size, bands)
+    session.update(frame)
+    # Next acquisition with one changed region, alternated so every run sees a change
+    changed = frame.copy()
+    changed[size // 4:size // 4 + 32, size // 4:size // 4 + 32] += 0.1
+    return session, [changed, frame]
+
+
+def _session_run(state):
+    session, frames = state
+    frames.reverse()
+    return session.update(frames[0])
+
+
+def _skull_removal_setup(size, bands):
+    skullremoval, model, _ = _gradcam_setup(size, bands)
+    return skullremoval, model, synthetic_mri_image(size, bands)
+
+
+def _skull_removal_run(state):
+    skullremoval, model, image = state
+    return skullremoval.skull_removal_with_gradcam(image, pretrained_model=model)
+
+
+def _skull_removal_artifact_setup(size, bands):
+    from skull_model_artifact import export_skull_model
+    skullremoval, model, image = _skull_removal_setup(size, bands)
+    path = export_skull_model(model, os.path.join(tempfile.mkdtemp(prefix='skull_model_bench_'), 'skull_model'))
+    return skullremoval, path, image
+
+
+def _skull_removal_tiled_run(state):
+    skullremoval, model, image = state
+    return skullremoval.skull_removal_with_gradcam(image, pretrained_model=model, gradcam_mode='tiled')
+
+
+# Benchmark cases: name -> (setup(size, bands) -> state, run(state))
+CASES = {
+    'normalize_hyperspectral_data': _heatmap_case('normalize_hyperspectral_data'),
+    'create_spectral_heatmap': _heatmap_case('create_spectral_heatmap'),
+    'spectral_heatmap_randomized': _pca_backend_case('randomized'),
+    'spectral_heatmap_subsample': _pca_backend_case('subsample'),
+    'spectral_heatmap_covariance': _pca_backend_case('covariance'),
+    'spectral_heatmap_basis': _pca_backend_case('basis'),
+    'create_spectral_index_heatmap': _heatmap_case('create_spectral_index_heatmap'),
+    'create_spectral_index_stack': _heatmap_case('create_spectral_index_stack'),
+    'apply_tissue_specific_heatmap': _heatmap_case('apply_tissue_specific_heatmap'),
+    'save_heatmaps': (_save_heatmaps_setup, _save_heatmaps_run),
+    'heatmap_session_update': (_session_setup, _session_run),
+    'generate_gradcam': (_gradcam_setup, _gradcam_run),
+    'gradcam_pool': (_gradcam_pool_setup, _gradcam_pool_run),
+    'synthetic_augmentation': (_augmentation_setup, _augmentation_run),
+    'skull_removal_with_gradcam': (_skull_removal_setup, _skull_removal_run),
+    'apply_brain_mask': (_apply_mask_setup, _apply_mask_run),
+    'skull_removal_tiled_gradcam': (_skull_removal_setup, _skull_removal_tiled_run),
+    'skull_removal_artifact': (_skull_removal_artifact_setup, _skull_removal_run),
+}
+
+# Minimum band count required by a case
+MIN_BANDS = {
+    'create_spectral_index_heatmap': 4,
+    'create_spectral_index_stack': 4,
+    'heatmap_session_update': 4,
+}
+
+
+# Cold-start cases: name -> (code run in a fresh interpreter, time budget in seconds,
+# modules that must not be imported by that code)
+STARTUP_CASES = {
+    'import_heatmap_generator': (
+        "import HyperspectralHeatmapGenerator",
+        0.5, ('tensorflow', 'sklearn', 'matplotlib', 'cv2'),
+    ),
+    'spectral_index_path': (
+        "import numpy as np\n"
+        "from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator\n"
+        "HyperspectralHeatmapGenerator().create_spectral_index_heatmap(np.random.rand(64, 64, 4), 'ndvi')",
+        0.5, ('tensorflow', 'sklearn', 'matplotlib', 'cv2'),
+    ),
+    'import_skullremoval': (
+        "import skullremoval",
+        0.75, ('tensorflow', 'sklearn', 'matplotlib', 'skimage', 'scipy'),
+    ),
+    'traditional_mask_path': (
+        "import numpy as np\n"
+        "import skullremoval\n"
+        "skullremoval.traditional_brain_mask(np.random.rand(64, 64))",
+        1.5, ('tensorflow', 'sklearn', 'matplotlib'),
+    ),
+}
+
+# float32 pipeline stages compared against the default float64 path:
+# name -> (run(generator, raw_cube, normalized_cube), max abs error allowed)
+PRECISION_CASES = {
+    'normalize_hyperspectral_data': (lambda gen, cube, norm: gen.normalize_hyperspectral_data(cube), 1e-5),
+    'normalize_tiled': (lambda gen, cube, norm: gen.normalize_hyperspectral_data(cube, tile_rows=64), 1e-5),
+    'create_spectral_heatmap': (lambda gen, cube, norm: gen.create_spectral_heatmap(norm), 1e-4),
+    'spectral_heatmap_covariance': (
+        lambda gen, cube, norm: gen.create_spectral_heatmap(norm, pca_backend='covariance'), 1e-4),
+    'spectral_heatmap_tiled': (lambda gen, cube, norm: gen.create_spectral_heatmap(norm, tile_rows=64), 1e-3),
+    # Ratio indices amplify rounding where the denominator is near zero
+    'create_spectral_index_heatmap': (lambda gen, cube, norm: gen.create_spectral_index_heatmap(norm, 'ndvi'), 1e-2),
+    'apply_tissue_specific_heatmap': (lambda gen, cube, norm: gen.apply_tissue_specific_heatmap(norm), 1e-6),
+}
+
+
+def compare_precision(size=256, bands=30):
+    """
+    Compare the float32 dtype policy with the default float64 path
+
+    Parameters:
+    - size: Image rows and columns
+    - bands: Number of spectral bands (at least 4)
+
+    Returns:
+    - List of dictionaries with the output dtype, max abs error and tolerance per stage
+    """
+    from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+    cube = synthetic_hyperspectral_cube(size, max(bands, 4))
+    generators = [HyperspectralHeatmapGenerator(), HyperspectralHeatmapGenerator(dtype=np.float32)]
+    normalized = [gen.normalize_hyperspectral_data(cube) for gen in generators]
+
+    results = []
+    for name, (run, tolerance) in PRECISION_CASES.items():
+        reference, result = (run(gen, cube, norm) for gen, norm in zip(generators, normalized))
+        error = float(np.max(np.abs(reference - result.astype(np.float64))))
+        results.append({
+            'case': name,
+            'dtype': str(result.dtype),
+            'max_abs_error': error,
+            'tolerance': tolerance,
+            # The policy holds only if no stage silently upcasts
+            'ok': result.dtype == np.float32 and error <= tolerance,
+        })
+    return results
+
+
+def run_precision_checks(size=256, bands=30):
+    """
+    Run all precision cases and print a line per case
+
+    Returns:
+    - List of result dictionaries
+    """
+    results = compare_precision(size, bands)
+    for result in results:
+        status = 'ok' if result['ok'] else 'FAILED'
+        print(f"{result['case']:<32} {result['dtype']:<8} max error {result['max_abs_error']:>10.3g}  "
+              f"tolerance {result['tolerance']:>7.0e}  {status}")
+    return results
+
+
+def _serve_gradcam_batch(model, cnn_input):
+    import skullremoval
+    skullremoval.generate_gradcam_batch(model, cnn_input, "final_conv", class_idx=1)
+
+
+def _serve_predict_batch(model, cnn_input):
+    import skullremoval
+    skullremoval.predict_brain_mask_batch(model, cnn_input)
+
+
+def _serve_gradcam_pool(model, cnn_input):
+    from gradcam_pool import GradCAMPool
+    pool = GradCAMPool(replicas=2, configure_threads=False)
+    # Enough requests for both workers (and so the cloned replica) to be used
+    for future in [pool.submit(model, cnn_input) for _ in range(8)]:
+        future.result()
+    # The pool is kept running: its caches must not hold the model either
+    return pool
+
+
+# Model release cases: name -> (model type, serve(model, cnn_input)); each
+# served model must be garbage-collectable once the caller drops it
+RELEASE_CASES = {
+    'generate_gradcam_batch': ('classifier', _serve_gradcam_batch),
+    'predict_brain_mask_batch': ('unet', _serve_predict_batch),
+    'gradcam_pool': ('classifier', _serve_gradcam_pool),
+}
+
+
+def run_release_checks(size=64):
+    """
+    Check that the inference caches do not keep served models alive, and print a line per case
+
+    Returns:
+    - List of result dictionaries
+    """
+    import gc
+    import weakref
+    import skullremoval
+
+    cnn_input, _ = skullremoval.prepare_cnn_input(synthetic_mri_image(size, 3))
+    results = []
+    for name, (model_type, serve) in RELEASE_CASES.items():
+        if model_type == 'unet':
+            model = skullremoval.create_segmentation_unet(cnn_input.shape[1:])
+        else:
+            model = skullremoval.create_simple_cnn(cnn_input.shape[1:])
+        keep = serve(model, cnn_input)
+        model_ref = weakref.ref(model)
+        del model
+        gc.collect()
+        ok = model_ref() is None
+        results.append({'case': name, 'ok': ok})
+        print(f"{name:<32} model released  {'ok' if ok else 'FAILED'}")
+        if keep is not None:
+            keep.close()
+    return results
+
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile(sys.argv[1], '<startup>', 'exec'))
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_startup(name, repeat=5):
+    """
+    Measure the cold-start time of a startup case in fresh interpreters
+
+    Parameters:
+    - name: Startup case name (key of STARTUP_CASES)
+    - repeat: Number of fresh interpreters to time
+
+    Returns:
+    - Dictionary with the best time, the budget and any heavy modules that were imported
+    """
+    code, budget, forbidden = STARTUP_CASES[name]
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+    times = []
+    loaded = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, code], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded.update(module for module in forbidden if module in result['modules'])
+
+    return {
+        'case': name,
+        'best_s': min(times),
+        'budget_s': budget,
+        'heavy_modules': sorted(loaded),
+        'ok': min(times) <= budget and not loaded,
+    }
+
+
+def run_startup_benchmarks(repeat=5):
+    """
+    Run all startup cases and print a line per case
+
+    Returns:
+    - List of result dictionaries
+    """
+    results = []
+    for name in STARTUP_CASES:
+        result = measure_startup(name, repeat)
+        results.append(result)
+        status = 'ok' if result['ok'] else 'OVER BUDGET'
+        heavy = f"  loaded {', '.join(result['heavy_modules'])}" if result['heavy_modules'] else ''
+        print(f"{name:<32} {result['best_s'] * 1000:>8.1f} ms  budget {result['budget_s'] * 1000:>6.0f} ms  {status}{heavy}")
+    return results
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(name, size, bands, repeat=3):
+    """
+    Benchmark one case at one image size and band count
+
+    Parameters:
+    - name: Case name (key of CASES)
+    - size: Image rows and columns
+    - bands: Number of spectral bands
+    - repeat: Number of timed runs
+
+    Returns:
+    - Dictionary with wall times, peak RSS and traced allocation peak
+    """
+    setup, run = CASES[name]
+    state = setup(size, bands)
+
+    # Warm-up run (graph building, caches), not timed
+    run(state)
+    rss_before = _peak_rss_mb()
+
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(state)
+        wall_times.append(time.perf_counter() - start)
+    peak_rss = _peak_rss_mb()
+
+    # Allocations are traced in a separate run so tracing does not skew the timings
+    tracemalloc.start()
+    run(state)
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if name == 'save_heatmaps':
+        shutil.rmtree(state[2], ignore_errors=True)
+
+    return {
+        'case': name,
+        'size': size,
+        'bands': bands,
+        'wall_median_s': statistics.median(wall_times),
+        'wall_min_s': min(wall_times),
+        'peak_rss_mb': peak_rss,
+        'peak_rss_delta_mb': peak_rss - rss_before,
+        'alloc_peak_mb': alloc_peak / (1024 * 1024),
+    }
+
+
+def _run_case_isolated(args):
+    return run_case(*args)
+
+
+def run_benchmarks(cases, sizes, band_counts, repeat=3, max_cube_mb=2048, isolate=True):
+    """
+    Run benchmark cases over a grid of image sizes and band counts
+
+    Parameters:
+    - cases: Case names to run
+    - sizes: Image sizes (rows = cols)
+    - band_counts: Band counts
+    - repeat: Number of timed runs per case
+    - max_cube_mb: Skip combinations whose float64 cube exceeds this size
+    - isolate: Run each case in a fresh process, so peak RSS is per case
+
+    Returns:
+    - List of result dictionaries
+    """
+    jobs = []
+    for name in cases:
+        for size in sizes:
+            for bands in band_counts:
+                if bands < MIN_BANDS.get(name, 1):
+                    continue
+                if size * size * bands * 8 / (1024 * 1024) > max_cube_mb:
+                    continue
+                jobs.append((name, size, bands, repeat))
+
+    results = []
+    for job in jobs:
+        if isolate:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(_run_case_isolated, job).result()
+        else:
+            result = run_case(*job)
+        results.append(result)
+        print(f"{result['case']:<32} {result['size']:>5}px {result['bands']:>4} bands  "
+              f"{result['wall_median_s'] * 1000:>10.1f} ms  "
+              f"rss {result['peak_rss_mb']:>8.1f} MB  alloc {result['alloc_peak_mb']:>8.1f} MB")
+    return results
+
+
+def _result_key(result):
+    return f"{result['case']}@{result['size']}x{result['bands']}"
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Compare results with a stored baseline
+
+    Parameters:
+    - results: Current results
+    - baseline: Baseline results (as saved with --save-baseline)
+    - tolerance: Allowed relative increase of median wall time and allocation peak
+
+    Returns:
+    - List of regression descriptions (empty if none)
+    """
+    baseline_by_key = {_result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        reference = baseline_by_key.get(_result_key(result))
+        if reference is None:
+            continue
+        for metric in ('wall_median_s', 'alloc_peak_mb'):
+            if reference[metric] > 0 and result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{_result_key(result)} {metric}: {reference[metric]:.4g} -> {result[metric]:.4g} "
+                    f"(+{(result[metric] / reference[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the skull removal and heatmap pipeline on synthetic data")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick', help="Size/band grid to run")
+    parser.add_argument('--sizes', type=int, nargs='+', help="Override image sizes")
+    parser.add_argument('--bands', type=int, nargs='+', help="Override band counts")
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=list(CASES), help="Cases to run")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per case")
+    parser.add_argument('--max-cube-mb', type=float, default=2048, help="Skip cubes larger than this (float64)")
+    parser.add_argument('--in-process', dest='isolate', action='store_false', help="Run all cases in this process")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Write results as a baseline JSON file")
+    parser.add_argument('--compare', metavar='PATH', help="Compare against a baseline and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative regression for --compare")
+    parser.add_argument('--startup', action='store_true', help="Only check cold-start import time budgets")
+    parser.add_argument('--precision', action='store_true', help="Only compare the float32 path with float64")
+    parser.add_argument('--release', action='store_true',
+                        help="Only check that served models can be garbage-collected")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        results = run_startup_benchmarks()
+        return 0 if all(result['ok'] for result in results) else 1
+
+    if args.precision:
+        results = run_precision_checks(*(args.sizes or [256])[:1], *(args.bands or [30])[:1])
+        return 0 if all(result['ok'] for result in results) else 1
+
+    if args.release:
+        results = run_release_checks()
+        return 0 if all(result['ok'] for result in results) else 1
+
+    preset = PRESETS[args.preset]
+    results = run_benchmarks(args.cases, args.sizes or preset['sizes'], args.bands or preset['bands'],
+                             repeat=args.repeat, max_cube_mb=args.max_cube_mb, isolate=args.isolate)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, baseline_file, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,304 @@
+import asyncio
+import os
+import queue
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from profiling import stage
+
+# Number of recent requests the latency percentiles are computed over
+_LATENCY_WINDOW = 4096
+
+
+def configure_tensorflow_threads(intra_op_threads, inter_op_threads=1):
+    """
+    Bound TensorFlow's CPU thread pools
+
+    The thread pools are process-wide and fixed once the TensorFlow runtime has
+    started, so call this before the first model is built or loaded. The OpenMP
+    (oneDNN) thread count, which limits the threads each op uses, is only picked
+    up if TensorFlow has not been imported yet.
+
+    Parameters:
+    - intra_op_threads: Threads shared by all ops for parallelism within an op
+    - inter_op_threads: Ops run concurrently
+
+    Returns:
+    - True if the settings were applied, False if the runtime was already initialized
+    """
+    if 'tensorflow' not in sys.modules:
+        os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra_op_threads)
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(inter_op_threads)
+
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        # Raised once the runtime is initialized, unless the values are unchanged
+        return (tf.config.threading.get_intra_op_parallelism_threads() == intra_op_threads
+                and tf.config.threading.get_inter_op_parallelism_threads() == inter_op_threads)
+    return True
+
+
+def clone_model(model):
+    """
+    Independent copy of a Keras model with the same architecture, layer names and weights
+
+    Exported artifacts are returned as is: their loaded functions hold no
+    per-call state and can be shared by every worker.
+    """
+    from skull_model_artifact import SkullModelArtifact
+    if isinstance(model, SkullModelArtifact):
+        return model
+
+    import tensorflow as tf
+
+    replica = tf.keras.models.clone_model(model)
+    replica.set_weights(model.get_weights())
+    return replica
+
+
+def _summarize(values):
+    if not values:
+        return {'mean': None, 'p50': None, 'p95': None, 'max': None}
+    values = np.asarray(values) * 1000
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'max': float(values.max()),
+    }
+
+
+class GradCAMPool:
+    def __init__(self, replicas=None, threads_per_replica=1, layer_name="final_conv", class_idx=1,
+                 max_batch_size=8, max_queue=0, configure_threads=True):
+        """
+        Thread-safe Grad-CAM inference pool
+
+        Each worker thread owns one replica of every model it serves, so
+        concurrent requests never share a model or its compiled Grad-CAM
+        function. Requests wait in a single queue; a worker takes all waiting
+        requests for the same model and input shape (up to max_batch_size) as
+        one batch. Replicas are cloned from a model the first time a worker
+        serves it, so they keep the weights the model had at that point.
+
+        Parameters:
+        - replicas: Number of worker threads and model replicas (default: CPU count // threads_per_replica)
+        - threads_per_replica: CPU threads each replica's ops may use
+        - layer_name: Name of the layer to use for Grad-CAM
+        - class_idx: Default index of the class to generate Grad-CAM for
+        - max_batch_size: Maximum number of images per pass
+        - max_queue: Maximum number of waiting requests before submit blocks (0: unbounded)
+        - configure_threads: Bound TensorFlow's thread pools to replicas * threads_per_replica
+          (see configure_tensorflow_threads)
+        """
+        if replicas is None:
+            replicas = max(1, (os.cpu_count() or 1) // max(1, threads_per_replica))
+        self.replicas = replicas
+        self.threads_per_replica = threads_per_replica
+        self.layer_name = layer_name
+        self.class_idx = class_idx
+        self.max_batch_size = max_batch_size
+        if configure_threads:
+            self.threads_configured = configure_tensorflow_threads(replicas * threads_per_replica, replicas)
+        else:
+            self.threads_configured = False
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Source model -> per-worker replicas. Worker 0 serves the source model
+        # itself, which is never stored in the value: a value referencing its
+        # own key would keep the model alive forever
+        self._replicas = weakref.WeakKeyDictionary()
+        self._replicas_lock = threading.Lock()
+
+        self._metrics_lock = threading.Lock()
+        self._latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._queue_waits = deque(maxlen=_LATENCY_WINDOW)
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._batches = 0
+        self._started = time.perf_counter()
+
+        self._closed = False
+        self._workers = [threading.Thread(target=self._run, args=(worker,), name=f'gradcam-pool-{worker}', daemon=True)
+                         for worker in range(replicas)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, model, cnn_input, class_idx=None):
+        """
+        Queue one image for Grad-CAM
+
+        Parameters:
+        - model: Trained CNN model
+        - cnn_input: Input image with batch dimension of 1
+        - class_idx: Index of the class to generate Grad-CAM for (default: the pool's class_idx)
+
+        Returns:
+        - Future resolving to the Grad-CAM heatmap
+        """
+        if self._closed:
+            raise RuntimeError("GradCAMPool is closed")
+        future = Future()
+        with self._metrics_lock:
+            self._submitted += 1
+        image = np.asarray(cnn_input[0], dtype=np.float32)
+        self._queue.put((model, image, self.class_idx if class_idx is None else class_idx,
+                         time.perf_counter(), future))
+        return future
+
+    def gradcam(self, model, cnn_input, class_idx=None):
+        """
+        Blocking Grad-CAM through the pool (usable as gradcam_fn for skull removal)
+        """
+        return self.submit(model, cnn_input, class_idx).result()
+
+    async def gradcam_async(self, model, cnn_input, class_idx=None):
+        """
+        Grad-CAM through the pool, awaitable from an asyncio event loop
+
+        Submission runs in the loop's default executor when the queue is bounded,
+        so a full queue does not block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._queue.maxsize:
+            future = await loop.run_in_executor(None, self.submit, model, cnn_input, class_idx)
+        else:
+            future = self.submit(model, cnn_input, class_idx)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def metrics(self):
+        """
+        Throughput and latency of the pool
+
+        Returns:
+        - Dictionary with request counts, the queue depth, throughput since the pool
+          started, mean batch size and latency and queue wait statistics in ms over
+          recent requests (mean, p50, p95, max)
+        """
+        with self._metrics_lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                'replicas': self.replicas,
+                'threads_per_replica': self.threads_per_replica,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'queued': self._queue.qsize(),
+                'elapsed_s': elapsed,
+                'throughput_per_s': self._completed / elapsed if elapsed > 0 else 0.0,
+                'mean_batch_size': (self._completed + self._failed) / self._batches if self._batches else None,
+                'latency_ms': _summarize(self._latencies),
+                'queue_wait_ms': _summarize(self._queue_waits),
+            }
+
+    def reset_metrics(self):
+        with self._metrics_lock:
+            self._latencies.clear()
+            self._queue_waits.clear()
+            self._submitted = self._completed = self._failed = self._batches = 0
+            self._started = time.perf_counter()
+
+    def close(self):
+        """
+        Stop the workers after the queued requests are done
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _replica(self, model, worker):
+        if worker == 0:
+            return model
+        with self._replicas_lock:
+            replicas = self._replicas.get(model)
+            if replicas is None:
+                replicas = self._replicas[model] = [None] * self.replicas
+            replica = replicas[worker]
+        if replica is None:
+            # Clone outside the lock; only this worker ever fills its own slot
+            replica = replicas[worker] = clone_model(model)
+        return replica
+
+    def _next_batch(self, item):
+        # Take every waiting request (up to max_batch_size) without waiting for more
+        batch = [item]
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, worker):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._process(self._next_batch(item), worker)
+            # Drop the last request while waiting, so its model can be collected
+            item = None
+
+    def _process(self, batch, worker):
+        import skullremoval
+
+        dequeued = time.perf_counter()
+
+        # One pass per model, input shape and class
+        groups = defaultdict(list)
+        for entry in batch:
+            model, image, class_idx, _, _ = entry
+            groups[(id(model), image.shape, class_idx)].append(entry)
+
+        for (_, _, class_idx), entries in groups.items():
+            heatmaps = error = None
+            try:
+                with stage('gradcam_pool.batch', worker=worker, size=len(entries)):
+                    replica = self._replica(entries[0][0], worker)
+                    heatmaps = skullremoval.generate_gradcam_batch(
+                        replica, np.stack([entry[1] for entry in entries]), self.layer_name, class_idx
+                    )
+            except Exception as e:
+                error = e
+
+            done = time.perf_counter()
+            with self._metrics_lock:
+                self._batches += 1
+                for entry in entries:
+                    self._queue_waits.append(dequeued - entry[3])
+                    self._latencies.append(done - entry[3])
+                if error is None:
+                    self._completed += len(entries)
+                else:
+                    self._failed += len(entries)
+
+            for i, entry in enumerate(entries):
+                if error is None:
+                    entry[4].set_result(heatmaps[i])
+                else:
+                    entry[4].set_exception(error)
@@ -0,0 +1,242 @@
+import numpy as np
+
+from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+from profiling import profiled, stage
+
+
+class HeatmapSession:
+    def __init__(self, generator=None, tile_size=64, tolerance=0.0, stats_tolerance=0.05,
+                 index_types=('ndvi', 'tumor'), enhancement_factor=1.5, pca_method='covariance'):
+        """
+        Stateful heatmap generation for repeated acquisitions of the same field of view
+
+        Band statistics are merged incrementally across frames, and the PCA basis is
+        kept between frames. Per-band work (normalization, projection, spectral
+        indices, intensity) is redone only for tiles whose pixels changed by more
+        than the tolerance. Only the cheap per-pixel finishing (range
+        normalization, contrast and tissue coloring) runs over the whole frame.
+        Normalization and basis are refreshed from the running statistics when
+        those drift beyond stats_tolerance.
+
+        Parameters:
+        - generator: HyperspectralHeatmapGenerator to use (dtype, tissue classes, indices)
+        - tile_size: Edge length of the change-detection tiles in pixels
+        - tolerance: Maximum absolute pixel change for a tile to count as unchanged
+        - stats_tolerance: Running mean/scale drift (relative to the band scale)
+          that triggers a full refresh
+        - index_types: Spectral indices to compute (empty to skip)
+        - enhancement_factor: Contrast enhancement of the spectral heatmap
+        - pca_method: Backend used to (re)fit the spectral basis (see spectral_pca)
+        """
+        self.generator = generator or HyperspectralHeatmapGenerator()
+        self.tile_size = tile_size
+        self.tolerance = tolerance
+        self.stats_tolerance = stats_tolerance
+        self.index_types = list(index_types)
+        self.enhancement_factor = enhancement_factor
+        self.pca_method = pca_method
+
+        self.frame_count = 0
+        self.basis = None
+
+        # Running band statistics over every pixel of every frame
+        self._count = 0
+        self._mean = None
+        self._m2 = None
+
+        # Per-band sums of the current frame about a fixed shift, updated from
+        # the changed tiles only
+        self._shift = None
+        self._frame_sum = None
+        self._frame_sumsq = None
+
+        # Statistics the current normalization and basis were built from
+        self._norm_mean = None
+        self._norm_scale = None
+
+        self._previous = None
+        self._projected = None
+        self._indices = None
+        self._intensity = None
+
+    @property
+    def band_mean(self):
+        return self._mean
+
+    @property
+    def band_scale(self):
+        scale = np.sqrt(self._m2 / self._count)
+        # Constant bands are left unscaled, as StandardScaler does
+        scale[scale == 0] = 1.0
+        return scale
+
+    def _tile_sums(self, pixels):
+        # Per-band sum and sum of squares of a tile about the shift
+        centered = np.subtract(pixels.reshape(-1, pixels.shape[2]), self._shift, dtype=np.float64)
+        return centered.sum(axis=0), np.einsum('ij,ij->j', centered, centered)
+
+    def _update_frame_sums(self, frame, tiles):
+        if self._shift is None:
+            # Shifting by the first frame's mean keeps the sums numerically stable
+            self._shift = frame.reshape(-1, frame.shape[2]).mean(axis=0, dtype=np.float64)
+            self._frame_sum, self._frame_sumsq = self._tile_sums(frame)
+            return
+        for tile in tiles:
+            old_sum, old_sumsq = self._tile_sums(self._previous[tile])
+            new_sum, new_sumsq = self._tile_sums(frame[tile])
+            self._frame_sum += new_sum - old_sum
+            self._frame_sumsq += new_sumsq - old_sumsq
+
+    def _merge_statistics(self, n):
+        # Merge the frame's per-band statistics into the running totals (Chan et al.)
+        frame_mean = self._shift + self._frame_sum / n
+        frame_m2 = np.maximum(self._frame_sumsq - self._frame_sum ** 2 / n, 0)
+
+        if self._count == 0:
+            self._count, self._mean, self._m2 = n, frame_mean, frame_m2
+            return
+
+        delta = frame_mean - self._mean
+        total = self._count + n
+        self._mean = self._mean + delta * (n / total)
+        self._m2 = self._m2 + frame_m2 + delta ** 2 * (self._count * n / total)
+        self._count = total
+
+    def _statistics_drifted(self):
+        scale = self.band_scale
+        mean_drift = np.max(np.abs(self._mean - self._norm_mean) / scale)
+        scale_drift = np.max(np.abs(scale - self._norm_scale) / scale)
+        return max(mean_drift, scale_drift) > self.stats_tolerance
+
+    def _tiles(self, rows, cols):
+        for row in range(0, rows, self.tile_size):
+            for col in range(0, cols, self.tile_size):
+                yield (slice(row, min(row + self.tile_size, rows)), slice(col, min(col + self.tile_size, cols)))
+
+    def _changed_tiles(self, frame):
+        changed = []
+        for tile in self._tiles(*frame.shape[:2]):
+            if self.tolerance == 0:
+                if not np.array_equal(frame[tile], self._previous[tile]):
+                    changed.append(tile)
+                continue
+            # Signed float difference, so unsigned integer cubes cannot wrap around
+            difference = np.abs(np.subtract(frame[tile], self._previous[tile], dtype=np.float64))
+            if difference.max() > self.tolerance:
+                changed.append(tile)
+        return changed
+
+    def _normalize(self, pixels):
+        normalized = np.array(pixels, dtype=self._norm_mean.dtype)
+        normalized -= self._norm_mean
+        normalized /= self._norm_scale
+        return normalized
+
+    def _refresh(self, frame):
+        # Normalize with the running statistics and refit the basis on this frame
+        dtype = self.generator.dtype or np.float64
+        self._norm_mean = self._mean.astype(dtype)
+        self._norm_scale = self.band_scale.astype(dtype)
+        self.basis = self.generator.fit_spectral_basis(self._normalize(frame), method=self.pca_method)
+
+    def _compute_tile(self, frame, tile):
+        normalized = self._normalize(frame[tile])
+        self._projected[tile] = self.basis.project(normalized)
+        if self.index_types:
+            self.generator.get_spectral_indices().evaluate(normalized, self.index_types, out=self._indices[tile])
+        np.mean(normalized, axis=2, out=self._intensity[tile])
+
+    @profiled('session.update')
+    def update(self, frame):
+        """
+        Process the next frame
+
+        Parameters:
+        - frame: Hyperspectral cube (rows, cols, bands) of the same field of view
+
+        Returns:
+        - Dictionary with the frame number, the 'spectral' heatmap, one entry per
+          spectral index, the 'tissue' heatmap, the number of recomputed tiles and
+          whether the normalization and basis were refreshed
+        """
+        frame = np.asarray(frame)
+        if frame.ndim != 3:
+            raise ValueError("Input must be a 3D hyperspectral image")
+        if self._previous is not None and frame.shape != self._previous.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match the session shape {self._previous.shape}")
+        # Checked up front, so a bad frame leaves the session state untouched
+        registry = self.generator.get_spectral_indices()
+        needed = max((registry.get(name).min_bands for name in self.index_types), default=0)
+        if frame.shape[2] < needed:
+            raise ValueError(f"Not enough spectral bands for index: need {needed}, got {frame.shape[2]}")
+
+        rows, cols = frame.shape[:2]
+        if self._previous is None:
+            dtype = self.generator.dtype or np.float64
+            self._previous = np.empty_like(frame)
+            self._projected = np.empty((rows, cols, 3), dtype=dtype)
+            self._indices = np.empty((rows, cols, len(self.index_types)), dtype=dtype)
+            self._intensity = np.empty((rows, cols), dtype=dtype)
+            tiles = list(self._tiles(rows, cols))
+        else:
+            with stage('session.change_detection'):
+                tiles = self._changed_tiles(frame)
+
+        with stage('session.statistics'):
+            self._update_frame_sums(frame, tiles)
+            self._merge_statistics(rows * cols)
+
+        refreshed = self.basis is None or self._statistics_drifted()
+        if refreshed:
+            with stage('session.refresh'):
+                self._refresh(frame)
+                # Every tile is copied into _previous below, including tiles that
+                # changed by less than the tolerance, so the frame sums must
+                # cover the whole frame again
+                self._frame_sum, self._frame_sumsq = self._tile_sums(frame)
+            tiles = list(self._tiles(rows, cols))
+
+        with stage('session.tiles', tiles=len(tiles)):
+            for tile in tiles:
+                self._compute_tile(frame, tile)
+                self._previous[tile] = frame[tile]
+
+        self.frame_count += 1
+        return self._emit(len(tiles), refreshed)
+
+    def _emit(self, n_tiles, refreshed):
+        # Whole-frame finishing steps write to new arrays, so emitted results are
+        # not overwritten by later frames
+        spectral = self._projected - self._projected.min()
+        spectral /= spectral.max()
+        np.power(spectral, 1.0 / self.enhancement_factor, out=spectral)
+
+        result = {
+            'frame': self.frame_count - 1,
+            'spectral': spectral,
+            'tissue': self.generator.tissue_heatmap_from_intensity(self._intensity),
+            'recomputed_tiles': n_tiles,
+            'refreshed': refreshed,
+        }
+
+        for i, index_type in enumerate(self.index_types):
+            index_map = self._indices[:, :, i]
+            index_min = index_map.min()
+            index_map = index_map - index_min
+            index_map /= self._indices[:, :, i].max() - index_min + 1e-10
+            result[index_type] = index_map
+
+        return result
+
+    def stream(self, frames):
+        """
+        Process frames lazily
+
+        Parameters:
+        - frames: Iterable of hyperspectral cubes of the same field of view
+
+        Yields:
+        - One result dictionary per frame (see update)
+        """
+        for frame in frames:
+            yield self.update(frame)
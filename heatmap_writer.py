@@ -0,0 +1,157 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# 8-bit RGB lookup tables per colormap name; the extra last row is used for NaN
+_colormap_luts = {}
+_colormap_lock = threading.Lock()
+
+
+def colormap_lut(name='jet'):
+    """
+    256-entry uint8 RGB lookup table for a matplotlib colormap
+
+    Entries equal (cmap(x)[:3] * 255).astype(np.uint8) for every x in the
+    corresponding 1/256 bin, so lookups reproduce matplotlib's output exactly.
+
+    Parameters:
+    - name: Matplotlib colormap name
+
+    Returns:
+    - Array of shape (257, 3); row 256 (black) is used for NaN values
+    """
+    with _colormap_lock:
+        lut = _colormap_luts.get(name)
+        if lut is None:
+            import matplotlib
+            cmap = matplotlib.colormaps[name]
+            lut = np.zeros((257, 3), dtype=np.uint8)
+            lut[:256] = (cmap((np.arange(256) + 0.5) / 256)[:, :3] * 255).astype(np.uint8)
+            _colormap_luts[name] = lut
+        return lut
+
+
+def heatmap_to_uint8(heatmap, colormap='jet'):
+    """
+    Convert a heatmap to 8-bit RGB
+
+    Parameters:
+    - heatmap: 2D map in [0, 1] (colormapped), RGB floats in [0, 1], or uint8 RGB
+    - colormap: Colormap applied to 2D maps
+
+    Returns:
+    - uint8 array of shape (rows, cols, 3)
+    """
+    if heatmap.dtype == np.uint8:
+        return heatmap
+    if len(heatmap.shape) == 2:
+        lut_idx = heatmap * 256
+        np.clip(lut_idx, 0, 255, out=lut_idx)
+        np.nan_to_num(lut_idx, copy=False, nan=256)
+        return np.take(colormap_lut(colormap), lut_idx.astype(np.intp), axis=0)
+    return (heatmap * 255).astype(np.uint8)
+
+
+def encode_heatmap(heatmap, fmt='png', compression=3, colormap='jet'):
+    """
+    Encode a heatmap as an image file in memory
+
+    Parameters:
+    - heatmap: Heatmap (see heatmap_to_uint8)
+    - fmt: 'png' or 'webp' (lossless), or any other extension OpenCV can encode
+    - compression: PNG compression level (0-9)
+    - colormap: Colormap applied to 2D maps
+
+    Returns:
+    - Encoded image bytes
+    """
+    rgb = heatmap_to_uint8(heatmap, colormap)
+    fmt = fmt.lower().lstrip('.')
+    if fmt == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+    elif fmt == 'webp':
+        # Quality above 100 selects lossless WebP
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        params = []
+
+    ok, encoded = cv2.imencode('.' + fmt, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise ValueError(f"Could not encode heatmap as {fmt}")
+    return encoded.tobytes()
+
+
+class HeatmapWriter:
+    def __init__(self, max_workers=4, compression=3, colormap='jet'):
+        """
+        Initialize an asynchronous heatmap writer
+
+        Parameters:
+        - max_workers: Number of encoding/writing threads
+        - compression: PNG compression level (0-9)
+        - colormap: Colormap applied to 2D maps
+        """
+        self.compression = compression
+        self.colormap = colormap
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='heatmap-writer')
+
+    def encode(self, heatmap, fmt='png'):
+        """
+        Encode a heatmap to bytes without touching disk
+        """
+        return encode_heatmap(heatmap, fmt, self.compression, self.colormap)
+
+    def write(self, output_path, heatmap):
+        """
+        Encode and write a heatmap synchronously; the format follows the file extension
+        """
+        fmt = os.path.splitext(output_path)[1] or '.png'
+        data = self.encode(heatmap, fmt)
+        with open(output_path, 'wb') as output_file:
+            output_file.write(data)
+        return output_path
+
+    def submit(self, output_path, heatmap):
+        """
+        Encode and write a heatmap on the thread pool
+
+        Returns:
+        - Future resolving to the output path
+        """
+        return self._pool.submit(self.write, output_path, heatmap)
+
+    def submit_encode(self, heatmap, fmt='png'):
+        """
+        Encode a heatmap to bytes on the thread pool
+
+        Returns:
+        - Future resolving to the encoded bytes
+        """
+        return self._pool.submit(self.encode, heatmap, fmt)
+
+    def write_many(self, output_dir, heatmaps, names):
+        """
+        Queue a batch of heatmaps for writing
+
+        Parameters:
+        - output_dir: Directory to save heatmaps
+        - heatmaps: List of heatmaps
+        - names: List of filenames for each heatmap
+
+        Returns:
+        - List of futures, one per heatmap
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        return [self.submit(os.path.join(output_dir, name), heatmap) for heatmap, name in zip(heatmaps, names)]
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
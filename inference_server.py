@@ -0,0 +1,374 @@
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+
+class MicroBatcher:
+    def __init__(self, max_batch_size=16, max_latency_ms=10, layer_name="final_conv", class_idx=1):
+        """
+        Coalesce concurrent Grad-CAM requests into batched forward/backward passes
+
+        Parameters:
+        - max_batch_size: Maximum number of images per batch
+        - max_latency_ms: Longest time the first request of a batch waits for others to join
+        - layer_name: Name of the layer to use for Grad-CAM
+        - class_idx: Index of the class to generate Grad-CAM for
+        """
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.layer_name = layer_name
+        self.class_idx = class_idx
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='gradcam-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, model, cnn_input):
+        """
+        Queue one image for Grad-CAM
+
+        Parameters:
+        - model: Trained CNN model
+        - cnn_input: Input image with batch dimension of 1
+
+        Returns:
+        - Future resolving to the Grad-CAM heatmap
+        """
+        future = Future()
+        self._queue.put((model, cnn_input[0], future))
+        return future
+
+    def gradcam(self, model, cnn_input):
+        """
+        Blocking Grad-CAM through the batcher (usable as gradcam_fn for skull removal)
+        """
+        return self.submit(model, cnn_input).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        import skullremoval
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+
+            # Collect more requests until the batch is full or the latency window closes
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            # One pass per model and input shape
+            groups = defaultdict(list)
+            for model, image, future in batch:
+                groups[(id(model), image.shape)].append((model, image, future))
+
+            for entries in groups.values():
+                model = entries[0][0]
+                try:
+                    heatmaps = skullremoval.generate_gradcam_batch(
+                        model, np.stack([image for _, image, _ in entries]), self.layer_name, self.class_idx
+                    )
+                except Exception as e:
+                    for _, _, future in entries:
+                        future.set_exception(e)
+                    continue
+                for (_, _, future), heatmap in zip(entries, heatmaps):
+                    future.set_result(heatmap)
+
+
+def decode_scan(body):
+    """
+    Decode an uploaded scan: .npy bytes or an encoded image (PNG, JPEG, TIFF)
+
+    Returns:
+    - Image normalized to [0, 1] with a band axis, as skullremoval.main prepares it
+    """
+    if body[:6] == b'\x93NUMPY':
+        image = np.load(io.BytesIO(body), allow_pickle=False)
+    else:
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError("Could not decode uploaded scan")
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    image = image.astype(np.float64)
+    image = (image - image.min()) / (image.max() - image.min())
+    if len(image.shape) == 2:
+        image = image[..., np.newaxis]
+    return image
+
+
+def _png_part(name, png_bytes):
+    return {'name': name, 'content_type': 'image/png', 'data': base64.b64encode(png_bytes).decode('ascii')}
+
+
+class InferenceService:
+    def __init__(self, model_registry=None, max_batch_size=16, max_latency_ms=10, cpu_workers=None,
+                 gradcam_replicas=None, threads_per_replica=1):
+        """
+        Skull removal and heatmap generation with a warm model pool and request batching
+
+        Parameters:
+        - model_registry: ModelRegistry holding the pre-loaded models (default: in-memory registry)
+        - max_batch_size: Maximum Grad-CAM batch size
+        - max_latency_ms: Grad-CAM batching window
+        - cpu_workers: Threads for the numpy/OpenCV stages (default: CPU count)
+        - gradcam_replicas: Serve Grad-CAM from a GradCAMPool with this many model
+          replicas instead of a single batching thread
+        - threads_per_replica: CPU threads per Grad-CAM replica
+        """
+        if model_registry is None:
+            from model_registry import ModelRegistry
+            model_registry = ModelRegistry(cache_dir=None)
+        self.model_registry = model_registry
+        if gradcam_replicas:
+            from gradcam_pool import GradCAMPool
+            self.batcher = GradCAMPool(gradcam_replicas, threads_per_replica, max_batch_size=max_batch_size)
+        else:
+            self.batcher = MicroBatcher(max_batch_size, max_latency_ms)
+        self.cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers or os.cpu_count() or 1,
+                                           thread_name_prefix='cpu-stage')
+
+    def skull_removal(self, image, heatmap_threshold=0.5, use_cnn=True):
+        """
+        Run skull removal, yielding encoded result parts as they become available
+        """
+        import skullremoval
+        from heatmap_writer import encode_heatmap
+
+        start = time.perf_counter()
+        _, brain_mask, gradcam_heatmap, _ = skullremoval.skull_removal_with_gradcam(
+            image, model_registry=self.model_registry, heatmap_threshold=heatmap_threshold,
+            use_cnn=use_cnn, gradcam_fn=self.batcher.gradcam
+        )
+        elapsed = time.perf_counter() - start
+
+        ok, mask_png = cv2.imencode('.png', brain_mask.astype(np.uint8) * 255)
+        if not ok:
+            raise ValueError("Could not encode brain mask as png")
+        yield _png_part('brain_mask.png', mask_png.tobytes())
+        if gradcam_heatmap is not None:
+            yield _png_part('gradcam.png', encode_heatmap(gradcam_heatmap, 'png', compression=1))
+        yield {'name': 'timings', 'skull_removal_s': elapsed}
+
+    def heatmaps(self, image):
+        """
+        Generate the PCA, spectral index and tissue heatmaps, yielding encoded parts
+        """
+        from HyperspectralHeatmapGenerator import HyperspectralHeatmapGenerator
+        from heatmap_writer import encode_heatmap
+
+        heatmap_gen = HyperspectralHeatmapGenerator()
+        start = time.perf_counter()
+        normalized_image = heatmap_gen.normalize_hyperspectral_data(image)
+
+        yield _png_part('pca_visualization.png',
+                        encode_heatmap(heatmap_gen.create_spectral_heatmap(normalized_image), 'png', compression=1))
+
+        try:
+            spectral_index_map = heatmap_gen.create_spectral_index_heatmap(normalized_image, 'tumor')
+        except ValueError:
+            # Fallback for images with fewer bands
+            spectral_index_map = np.mean(normalized_image, axis=2)
+        yield _png_part('spectral_index.png', encode_heatmap(spectral_index_map, 'png', compression=1))
+
+        tissue_heatmap = heatmap_gen.apply_tissue_specific_heatmap(normalized_image, as_uint8=True)
+        yield _png_part('tissue_specific.png', encode_heatmap(tissue_heatmap, 'png', compression=1))
+        yield {'name': 'timings', 'heatmaps_s': time.perf_counter() - start}
+
+    def run_on_pool(self, parts):
+        """
+        Drive a part generator on the CPU worker pool, yielding parts to the caller's thread
+        """
+        results = queue.Queue()
+
+        def produce():
+            try:
+                for part in parts:
+                    results.put(part)
+            except Exception as e:
+                results.put(e)
+            results.put(None)
+
+        self.cpu_pool.submit(produce)
+        while True:
+            part = results.get()
+            if part is None:
+                return
+            if isinstance(part, Exception):
+                raise part
+            yield part
+
+    def close(self):
+        self.batcher.close()
+        self.cpu_pool.shutdown()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._send_cors_headers()
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        self._send_json(200, {'status': 'ok', 'models': len(self.server.service.model_registry)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image = decode_scan(body)
+            if url.path == '/skull-removal':
+                parts = service.skull_removal(
+                    image,
+                    heatmap_threshold=float(params.get('heatmap_threshold', 0.5)),
+                    use_cnn=params.get('use_cnn', '1') not in ('0', 'false'),
+                )
+            elif url.path == '/heatmaps':
+                parts = service.heatmaps(image)
+            else:
+                self._send_json(404, {'error': 'Not found'})
+                return
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        # Stream one JSON line per result part as soon as it is encoded
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for part in service.run_on_pool(parts):
+                self._write_chunk((json.dumps(part) + '\n').encode())
+        except Exception as e:
+            self._write_chunk((json.dumps({'name': 'error', 'error': f"{type(e).__name__}: {e}"}) + '\n').encode())
+        self._write_chunk(b'')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_cors_headers(self):
+        if self.server.cors_origin:
+            self.send_header('Access-Control-Allow-Origin', self.server.cors_origin)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self._send_cors_headers()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def create_server(service, host='127.0.0.1', port=8000, cors_origin='*', verbose=False):
+    """
+    Create the HTTP server for an InferenceService
+
+    Endpoints:
+    - GET /health
+    - POST /skull-removal (body: .npy or image bytes; query: heatmap_threshold, use_cnn)
+    - POST /heatmaps (body: .npy or image bytes)
+
+    POST responses stream newline-delimited JSON parts with base64-encoded PNGs.
+    """
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.cors_origin = cors_origin
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve skull removal and heatmaps over HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--model-cache-dir', default='model_cache', help="Directory of trained models to pre-load")
+    parser.add_argument('--max-batch', type=int, default=16, help="Maximum Grad-CAM batch size")
+    parser.add_argument('--max-latency-ms', type=float, default=10, help="Grad-CAM batching window")
+    parser.add_argument('--cpu-workers', type=int, default=None, help="Threads for the numpy/OpenCV stages")
+    parser.add_argument('--gradcam-replicas', type=int, default=None,
+                        help="Serve Grad-CAM from this many model replicas in parallel")
+    parser.add_argument('--threads-per-replica', type=int, default=1, help="CPU threads per Grad-CAM replica")
+    parser.add_argument('--cors-origin', default='*', help="Allowed origin for the dashboard")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    args = parser.parse_args(argv)
+
+    if args.gradcam_replicas:
+        # Thread pools must be sized before the first model is loaded
+        from gradcam_pool import configure_tensorflow_threads
+        configure_tensorflow_threads(args.gradcam_replicas * args.threads_per_replica, args.gradcam_replicas)
+
+    from model_registry import ModelRegistry
+    model_registry = ModelRegistry(cache_dir=args.model_cache_dir)
+
+    # Pre-load every saved model, so the first requests do not pay for loading
+    if os.path.isdir(args.model_cache_dir):
+        for name in sorted(os.listdir(args.model_cache_dir)):
+            prefix = model_registry.prefix + '_'
+            if name.startswith(prefix) and name.endswith('.keras') and '.tmp-' not in name:
+                variant, shape = model_registry.parse_key(name[len(prefix):-len('.keras')])
+                model_registry.get(shape, variant)
+                print(f"Loaded {variant or 'classifier'} model for input shape {shape}")
+
+    service = InferenceService(model_registry, args.max_batch, args.max_latency_ms, args.cpu_workers,
+                               args.gradcam_replicas, args.threads_per_replica)
+    server = create_server(service, args.host, args.port, args.cors_origin, args.verbose)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    def __init__(self, cache_dir="model_cache", max_models=4, prefix="skull_model"):
+        """
+        Initialize a registry of trained models kept in memory and on disk
+
+        Parameters:
+        - cache_dir: Directory where trained models are saved (None keeps them in memory only)
+        - max_models: Maximum number of models held in memory before the least-recently-used one is evicted
+        - prefix: Filename prefix for models saved to disk
+        """
+        self.cache_dir = cache_dir
+        self.max_models = max_models
+        self.prefix = prefix
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+        # One lock per key being loaded or trained, so slow disk loads and
+        # training never block lookups of other keys; removed once done
+        self._key_locks = {}
+
+    def key_for(self, input_shape, variant=None):
+        """
+        Build the registry key for a model input shape
+
+        Parameters:
+        - input_shape: Model input shape (rows, cols, bands), without batch dimension
+        - variant: Optional model variant (e.g. "unet") stored alongside the default model
+
+        Returns:
+        - Key string such as "224x224x3" or "unet_224x224x3"
+        """
+        key = "x".join(str(int(dim)) for dim in input_shape)
+        return f"{variant}_{key}" if variant else key
+
+    def parse_key(self, key):
+        """
+        Split a registry key into its variant (or None) and input shape
+        """
+        variant, _, shape = key.rpartition('_')
+        return variant or None, tuple(int(dim) for dim in shape.split('x'))
+
+    def model_path(self, input_shape, variant=None):
+        """
+        Path of the on-disk copy of the model for an input shape
+        """
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{self.prefix}_{self.key_for(input_shape, variant)}.keras")
+
+    def get(self, input_shape, variant=None):
+        """
+        Look up a trained model, first in memory and then on disk
+
+        Parameters:
+        - input_shape: Model input shape (rows, cols, bands)
+        - variant: Optional model variant
+
+        Returns:
+        - Trained model, or None if no model is registered for this shape
+        """
+        key = self.key_for(input_shape, variant)
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        try:
+            with key_lock:
+                return self._load(key, input_shape, variant)
+        finally:
+            self._release_key_lock(key, key_lock)
+
+    def put(self, input_shape, model, save=True, variant=None):
+        """
+        Register a trained model for an input shape
+
+        Parameters:
+        - input_shape: Model input shape (rows, cols, bands)
+        - model: Trained model
+        - save: Whether to also write the model to the cache directory
+        - variant: Optional model variant
+        """
+        key = self.key_for(input_shape, variant)
+        with self._lock:
+            self._remember(key, model)
+        path = self.model_path(input_shape, variant)
+        if save and path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write then rename, so concurrent readers never see a partial file
+            tmp_path = f"{path[:-len('.keras')]}.tmp-{os.getpid()}-{threading.get_ident()}.keras"
+            model.save(tmp_path)
+            os.replace(tmp_path, path)
+
+    def get_or_train(self, input_shape, train_fn, variant=None):
+        """
+        Return the registered model for an input shape, training it on first use
+
+        Concurrent callers for the same key wait for a single training run;
+        lookups and training of other keys are not blocked meanwhile.
+
+        Parameters:
+        - input_shape: Model input shape (rows, cols, bands)
+        - train_fn: Callable with no arguments that returns a newly trained model
+        - variant: Optional model variant
+
+        Returns:
+        - Trained model
+        """
+        key = self.key_for(input_shape, variant)
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        try:
+            with key_lock:
+                # Another caller may have loaded or trained the model while this one waited
+                model = self._load(key, input_shape, variant)
+                if model is None:
+                    model = train_fn()
+                    self.put(input_shape, model, variant=variant)
+                return model
+        finally:
+            self._release_key_lock(key, key_lock)
+
+    def evict(self, input_shape=None, variant=None):
+        """
+        Drop models from memory (files on disk are kept)
+
+        Parameters:
+        - input_shape: Shape to evict (default: evict everything)
+        - variant: Optional model variant of the shape to evict
+        """
+        with self._lock:
+            if input_shape is None:
+                self._models.clear()
+                self._key_locks.clear()
+            else:
+                key = self.key_for(input_shape, variant)
+                self._models.pop(key, None)
+                self._key_locks.pop(key, None)
+
+    def __contains__(self, input_shape, variant=None):
+        """
+        Whether a model is registered, in memory or on disk
+
+        Parameters:
+        - input_shape: Model input shape, or a registry key such as "unet_224x224x3"
+          (so variants can be tested with the in operator)
+        - variant: Optional model variant
+        """
+        if isinstance(input_shape, str):
+            variant, input_shape = self.parse_key(input_shape)
+        with self._lock:
+            if self.key_for(input_shape, variant) in self._models:
+                return True
+        path = self.model_path(input_shape, variant)
+        return path is not None and os.path.exists(path)
+
+    def __len__(self):
+        return len(self._models)
+
+    def _lookup(self, key):
+        # In-memory lookup; the caller holds self._lock
+        model = self._models.get(key)
+        if model is not None:
+            # Mark as most recently used
+            self._models.move_to_end(key)
+        return model
+
+    def _load(self, key, input_shape, variant):
+        # Load from disk under the key's lock only, so other keys stay available
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+        path = self.model_path(input_shape, variant)
+        if path is None or not os.path.exists(path):
+            return None
+
+        import tensorflow as tf
+        model = tf.keras.models.load_model(path)
+        with self._lock:
+            self._remember(key, model)
+        return model
+
+    def _release_key_lock(self, key, key_lock):
+        # Waiters still hold their reference to the lock; later callers find the
+        # model in memory or create a new lock
+        with self._lock:
+            if self._key_locks.get(key) is key_lock:
+                del self._key_locks[key]
+
+    def _remember(self, key, model):
+        self._models[key] = model
+        self._models.move_to_end(key)
+        # Evict least-recently-used models beyond the memory budget
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
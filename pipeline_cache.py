@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+
+# Rows hashed per chunk, so memory-mapped inputs are never fully materialized
+_HASH_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def hash_array(array):
+    """
+    Content hash of an array (dtype, shape and data)
+
+    Parameters:
+    - array: Input array (may be a memory map or a non-contiguous view)
+
+    Returns:
+    - Hex digest string
+    """
+    array = np.asanyarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+
+    if array.ndim == 0 or array.size == 0:
+        digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    row_bytes = max(1, array[0].nbytes)
+    step = max(1, _HASH_CHUNK_BYTES // row_bytes)
+    for start in range(0, array.shape[0], step):
+        digest.update(np.ascontiguousarray(array[start:start + step]).data)
+    return digest.hexdigest()
+
+
+def memmap_key(array):
+    """
+    Key of a read-only memory-mapped array from its file and layout, without reading its data
+
+    The key covers the file (path, size and modification time) and the bytes
+    the array views (offset, dtype, shape and strides), so band or row views
+    of the same file get different keys.
+
+    Parameters:
+    - array: Input array
+
+    Returns:
+    - Hex digest string, or None if the array is not a read-only view of a file
+    """
+    filename = getattr(array, 'filename', None)
+    if not isinstance(array, np.memmap) or filename is None or array.mode != 'r' or array.flags.writeable:
+        return None
+
+    # The outermost array owns the mapping and starts at its offset in the file
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    start = root.offset + array.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    description = json.dumps([os.path.realpath(filename), stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                              start, array.dtype.str, array.shape, array.strides])
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+def hash_model(model):
+    """
+    Content hash of a Keras model's weights
+    """
+    # Exported artifacts carry the hash of the model they were exported from
+    content_hash = getattr(model, 'content_hash', None)
+    if content_hash is not None:
+        return content_hash
+
+    digest = hashlib.blake2b(digest_size=16)
+    for weights in model.get_weights():
+        digest.update(hash_array(weights).encode())
+    return digest.hexdigest()
+
+
+class ArrayCache:
+    def __init__(self, cache_dir="pipeline_cache", max_bytes=2 * 1024 ** 3, compress=False):
+        """
+        Initialize a content-addressed on-disk cache for intermediate arrays
+
+        Parameters:
+        - cache_dir: Directory where cached arrays are stored
+        - max_bytes: Size budget; least-recently-used entries are evicted beyond it
+        - compress: Store entries with zlib compression (smaller but slower)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._lock = threading.Lock()
+        # Keys of arrays produced by (or registered with) this cache, by object id
+        self._known_keys = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, parent, stage, **params):
+        """
+        Build the key of a pipeline stage from its input key and parameters
+
+        Parameters:
+        - parent: Key (or content hash) of the stage input
+        - stage: Stage name
+        - params: Stage parameters that affect the result
+
+        Returns:
+        - Hex digest string
+        """
+        description = json.dumps([parent, stage, sorted(params.items())], default=repr)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def content_key(self, array):
+        """
+        Key identifying an array's content
+
+        Arrays returned by get_or_compute are recognized without being rehashed,
+        so downstream stages chain on their upstream key. The key is looked up by
+        object identity, which is only safe while the content cannot change:
+        remember makes the array read-only, and an array that has been made
+        writeable again (or any other array) is hashed. Writing through another
+        writeable view of the same memory is not detected. Read-only memory maps
+        are keyed by their file and layout instead of their data (see memmap_key),
+        so a cube on disk is not read just to build a key.
+        """
+        known = self._known_keys.get(id(array))
+        if known is not None and known[0]() is array and not array.flags.writeable:
+            return known[1]
+        return memmap_key(array) or hash_array(array)
+
+    def remember(self, array, key):
+        """
+        Associate an array object with a key for later content_key calls
+
+        The array is made read-only, so in-place edits cannot leave it with a
+        stale key; copy it to modify it.
+        """
+        if not isinstance(array, np.ndarray):
+            return
+        array.setflags(write=False)
+        ref = weakref.ref(array, lambda _, array_id=id(array): self._known_keys.pop(array_id, None))
+        self._known_keys[id(array)] = (ref, key)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """
+        Load a cached entry
+
+        Returns:
+        - Tuple of arrays, or None on a cache miss
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = []
+                for i in range(len(data.files) // 2):
+                    array = data[f'arr_{i}']
+                    shape = tuple(data[f'shape_{i}'])
+                    if array.dtype == np.uint8 and shape != array.shape:
+                        # Boolean arrays are stored bit-packed
+                        array = np.unpackbits(array, count=int(np.prod(shape))).reshape(shape).astype(bool)
+                    arrays.append(array)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+        return tuple(arrays)
+
+    def save(self, key, arrays):
+        """
+        Store a tuple of arrays under a key, then evict old entries beyond the size budget
+        """
+        entries = {}
+        for i, array in enumerate(arrays):
+            array = np.asarray(array)
+            entries[f'shape_{i}'] = np.array(array.shape, dtype=np.int64)
+            entries[f'arr_{i}'] = np.packbits(array, axis=None) if array.dtype == bool else array
+
+        path = self.path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'wb') as tmp_file:
+            if self.compress:
+                np.savez_compressed(tmp_file, **entries)
+            else:
+                np.savez(tmp_file, **entries)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def get_or_compute(self, key, compute_fn):
+        """
+        Return the cached result of a stage, computing and storing it on a miss
+
+        Parameters:
+        - key: Stage key (see key)
+        - compute_fn: Callable with no arguments returning an array or a tuple of arrays
+
+        Returns:
+        - The array (or tuple of arrays) returned by compute_fn, made read-only (see remember)
+        """
+        arrays = self.load(key)
+        if arrays is None:
+            result = compute_fn()
+            single = not isinstance(result, tuple)
+            arrays = (result,) if single else result
+            self.save(key, arrays)
+        else:
+            single = len(arrays) == 1
+
+        for i, array in enumerate(arrays):
+            self.remember(array, self.key(key, 'output', index=i))
+        return arrays[0] if single else arrays
+
+    def evict(self):
+        """
+        Remove least-recently-used entries until the cache fits its size budget
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
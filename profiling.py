@@ -0,0 +1,275 @@
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Environment variable enabling profiling at import time:
+# "log" (or "1") logs every stage, "jsonl:<path>" appends JSON lines to a file
+PROFILE_ENV_VAR = 'PIPELINE_PROFILE'
+
+logger = logging.getLogger('pipeline.profile')
+
+# Active sinks; profiling is disabled while this is empty
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+# Stack of open stage names per thread, for nesting
+_stage_local = threading.local()
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def describe_array(array):
+    """
+    Shape and dtype of an array as a JSON-serializable dictionary (None for non-arrays)
+    """
+    if not isinstance(array, np.ndarray):
+        return None
+    return {'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+
+class LogSink:
+    def __init__(self, log=None, level=logging.INFO):
+        """
+        Sink writing one log line per stage
+
+        Parameters:
+        - log: Logger to use (default: the 'pipeline.profile' logger)
+        - level: Logging level of the records
+        """
+        self.log = log or logger
+        self.level = level
+
+    def emit(self, record):
+        arrays = ' '.join(f"{name}={info['shape']}:{info['dtype']}" for name, info in record['arrays'].items())
+        self.log.log(self.level, "%s wall %.1f ms cpu %.1f ms peak rss +%.1f MB %s", record['stage'],
+                     record['wall_s'] * 1000, record['cpu_s'] * 1000, record['peak_rss_delta_mb'], arrays)
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        """
+        Sink appending one JSON object per stage to a file
+
+        Parameters:
+        - path: Output .jsonl path
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as jsonl_file:
+                jsonl_file.write(line)
+
+
+class MemorySink:
+    def __init__(self):
+        """
+        Sink collecting stage records in memory
+        """
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        """
+        Total wall and CPU time and call count per stage
+
+        Returns:
+        - Dictionary stage -> {'calls', 'wall_s', 'cpu_s'}
+        """
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+                total['calls'] += 1
+                total['wall_s'] += record['wall_s']
+                total['cpu_s'] += record['cpu_s']
+        return totals
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+
+def add_sink(sink):
+    """
+    Enable profiling into a sink (anything with an emit(record) method)
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(active for active in _sinks if active is not sink)
+
+
+def enabled():
+    return bool(_sinks)
+
+
+@contextmanager
+def profile(*sinks):
+    """
+    Profile everything run inside the block
+
+    Parameters:
+    - sinks: Sinks to emit to (default: a new MemorySink)
+
+    Yields:
+    - The first sink, e.g. to read MemorySink.records afterwards
+    """
+    sinks = sinks or (MemorySink(),)
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield sinks[0]
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+class _Stage:
+    __slots__ = ('name', 'arrays', 'info', '_start_wall', '_start_cpu', '_start_rss')
+
+    def __init__(self, name, info):
+        self.name = name
+        self.arrays = {}
+        self.info = info
+
+    def arrays_used(self, **arrays):
+        """
+        Record shapes and dtypes of arrays consumed or produced by the stage
+        """
+        for name, array in arrays.items():
+            description = describe_array(array)
+            if description is not None:
+                self.arrays[name] = description
+
+    def __enter__(self):
+        stack = getattr(_stage_local, 'stack', None)
+        if stack is None:
+            stack = _stage_local.stack = []
+        stack.append(self.name)
+        self._start_rss = _peak_rss_mb()
+        self._start_cpu = time.process_time()
+        self._start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._start_wall
+        cpu = time.process_time() - self._start_cpu
+        stack = _stage_local.stack
+        stack.pop()
+        record = {
+            'stage': self.name,
+            'parent': stack[-1] if stack else None,
+            'thread': threading.current_thread().name,
+            'start': time.time() - wall,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_rss_delta_mb': _peak_rss_mb() - self._start_rss,
+            'arrays': self.arrays,
+            'error': exc_type.__name__ if exc_type is not None else None,
+        }
+        record.update(self.info)
+        for sink in _sinks:
+            try:
+                sink.emit(record)
+            except Exception:
+                logger.exception("Profiling sink failed")
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def arrays_used(self, **arrays):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **info):
+    """
+    Context manager timing a pipeline stage
+
+    Records wall time, CPU time (process-wide, so work in TensorFlow and OpenCV
+    threads counts) and the growth of the process peak RSS. When profiling is
+    disabled a shared no-op object is returned.
+
+    Parameters:
+    - name: Stage name
+    - info: Extra JSON-serializable fields for the record
+
+    Returns:
+    - Context manager whose arrays_used(**arrays) records array shapes and dtypes
+    """
+    if not _sinks:
+        return _NULL_STAGE
+    return _Stage(name, info)
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as a stage; the first array
+    argument and an array result are recorded as 'input' and 'output'
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            with _Stage(name, {}) as current:
+                for arg in args:
+                    if isinstance(arg, np.ndarray):
+                        current.arrays_used(input=arg)
+                        break
+                result = function(*args, **kwargs)
+                current.arrays_used(output=result)
+                return result
+        return wrapper
+    return decorator
+
+
+def _configure_from_env():
+    setting = os.environ.get(PROFILE_ENV_VAR, '').strip()
+    if not setting or setting == '0':
+        return
+    if setting.startswith('jsonl:'):
+        add_sink(JsonLinesSink(setting[len('jsonl:'):]))
+    else:
+        # Make the records visible without requiring logging to be configured
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+        add_sink(LogSink())
+
+
+_configure_from_env()
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+
+# Metadata file written next to the SavedModel files
+METADATA_FILE = 'skull_model.json'
+
+ARTIFACT_FORMAT = 1
+
+
+def export_skull_model(model, path, model_type='classifier', layer_name="final_conv"):
+    """
+    Export a trained skull model as a frozen inference artifact
+
+    The artifact is a SavedModel directory holding the model weights and
+    traced inference functions: the forward pass and, for classifiers, the
+    batched Grad-CAM function (normalized and raw) for layer_name. Loading it
+    needs neither the model-building code nor Keras, and nothing is retraced.
+
+    Parameters:
+    - model: Trained Keras model (see create_simple_cnn and create_segmentation_unet)
+    - path: Output directory
+    - model_type: 'classifier' or 'unet'
+    - layer_name: Name of the layer to use for Grad-CAM (classifiers only)
+
+    Returns:
+    - path
+    """
+    import tensorflow as tf
+    import skullremoval
+    from pipeline_cache import hash_model
+
+    if model_type not in skullremoval.MODEL_TYPES:
+        raise ValueError(f"Unsupported model type: {model_type}")
+
+    input_shape = tuple(int(dim) for dim in model.inputs[0].shape[1:])
+    input_spec = tf.TensorSpec((None,) + input_shape, tf.float32)
+
+    module = tf.Module()
+    # Tracking the model saves its variables with the functions that use them
+    module.model = model
+    module.predict = tf.function(lambda images: model(images, training=False), input_signature=[input_spec])
+    if model_type == 'classifier':
+        module.gradcam = skullremoval._build_gradcam_function(model, layer_name, normalize=True)
+        module.gradcam_raw = skullremoval._build_gradcam_function(model, layer_name, normalize=False)
+
+    tf.saved_model.save(module, path)
+
+    metadata = {
+        'format': ARTIFACT_FORMAT,
+        'model_type': model_type,
+        'input_shape': list(input_shape),
+        'layer_name': layer_name if model_type == 'classifier' else None,
+        # Hash of the exported weights, so cached results are shared with the live model
+        'content_hash': hash_model(model),
+    }
+    with open(os.path.join(path, METADATA_FILE), 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    return path
+
+
+class SkullModelArtifact:
+    def __init__(self, path):
+        """
+        Lazily loaded skull model artifact (see export_skull_model)
+
+        Only the metadata is read here; the SavedModel is loaded and warmed up
+        (one call per inference function) on first use, once per process.
+
+        Parameters:
+        - path: Artifact directory
+        """
+        self.path = path
+        metadata_path = os.path.join(path, METADATA_FILE)
+        if not os.path.isfile(metadata_path):
+            raise ValueError(f"Not a skull model artifact: {path}")
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata.get('format') != ARTIFACT_FORMAT:
+            raise ValueError(f"Unsupported skull model artifact format: {metadata.get('format')}")
+
+        self.model_type = metadata['model_type']
+        self.input_shape = tuple(metadata['input_shape'])
+        self.layer_name = metadata['layer_name']
+        self.content_hash = metadata['content_hash']
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._loaded is not None
+
+    def load(self):
+        """
+        Load the SavedModel and run each inference function once
+
+        Returns:
+        - self
+        """
+        with self._lock:
+            if self._loaded is None:
+                import numpy as np
+                import tensorflow as tf
+
+                loaded = tf.saved_model.load(self.path)
+                warmup = np.zeros((1,) + self.input_shape, dtype=np.float32)
+                loaded.predict(warmup)
+                if self.model_type == 'classifier':
+                    class_idx = tf.constant(0, dtype=tf.int32)
+                    loaded.gradcam(warmup, class_idx)
+                    loaded.gradcam_raw(warmup, class_idx)
+                self._loaded = loaded
+        return self
+
+    def get_gradcam_function(self, layer_name, normalize=True):
+        """
+        Exported Grad-CAM function, with the signature of skullremoval.get_gradcam_function's result
+        """
+        if self.model_type != 'classifier':
+            raise ValueError("Grad-CAM is only exported for classifier models")
+        if layer_name != self.layer_name:
+            raise ValueError(f"Artifact was exported for Grad-CAM on layer {self.layer_name}, not {layer_name}")
+        loaded = self.load()._loaded
+        return loaded.gradcam if normalize else loaded.gradcam_raw
+
+    def get_predict_function(self):
+        """
+        Exported forward pass, mapping a float32 image batch to model outputs
+        """
+        return self.load()._loaded.predict
+
+
+# Artifacts by absolute path, shared by every caller in the process
+_artifacts = {}
+_artifacts_lock = threading.Lock()
+
+
+def load_skull_model(path, warm=False):
+    """
+    Get the process-wide artifact for a path
+
+    Parameters:
+    - path: Artifact directory
+    - warm: Load and warm up now instead of on first use
+
+    Returns:
+    - SkullModelArtifact
+    """
+    key = os.path.abspath(os.fspath(path))
+    with _artifacts_lock:
+        artifact = _artifacts.get(key)
+        if artifact is None:
+            artifact = _artifacts[key] = SkullModelArtifact(key)
+    return artifact.load() if warm else artifact
@@ -1,10 +1,14 @@
+import os
+import threading
+import weakref
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import scipy.ndimage as ndimage
-from skimage import filters, morphology
-import tensorflow as tf
-from tensorflow.keras import models, layers
+from pipeline_cache import hash_model
+from profiling import profiled, stage
+from skull_model_artifact import SkullModelArtifact, load_skull_model
+
+# TensorFlow, scipy, skimage and matplotlib are imported inside the functions
+# that need them, so importing this module stays fast
 
 def create_simple_cnn(input_shape):
     """
@@ -16,6 +20,8 @@ def create_simple_cnn(input_shape):
     Returns:
     - CNN model
     """
+    from tensorflow.keras import models, layers
+    
     model = models.Sequential([
         layers.Input(shape=input_shape),
         layers.Conv2D(16, (3, 3), activation='relu', padding='same'),
@@ -30,6 +36,149 @@ def create_simple_cnn(input_shape):
     model.compile(optimizer='adam', loss='binary_crossentropy')
     return model
 
+def create_segmentation_unet(input_shape, base_filters=8):
+    """
+    Create a small U-Net that predicts the brain mask directly
+    
+    Parameters:
+    - input_shape: Shape of input image (rows and cols divisible by 4)
+    - base_filters: Filters of the first encoder block (doubled per level)
+    
+    Returns:
+    - Fully convolutional model mapping images to per-pixel brain probabilities (rows, cols, 1)
+    """
+    from tensorflow.keras import models, layers
+    
+    def conv_block(x, filters):
+        x = layers.Conv2D(filters, (3, 3), activation='relu', padding='same')(x)
+        return layers.Conv2D(filters, (3, 3), activation='relu', padding='same')(x)
+    
+    inputs = layers.Input(shape=input_shape)
+    
+    # Encoder
+    enc1 = conv_block(inputs, base_filters)
+    enc2 = conv_block(layers.MaxPooling2D((2, 2))(enc1), base_filters * 2)
+    bottleneck = conv_block(layers.MaxPooling2D((2, 2))(enc2), base_filters * 4)
+    
+    # Decoder with skip connections
+    dec2 = layers.Conv2DTranspose(base_filters * 2, (2, 2), strides=2, padding='same')(bottleneck)
+    dec2 = conv_block(layers.Concatenate()([dec2, enc2]), base_filters * 2)
+    dec1 = layers.Conv2DTranspose(base_filters, (2, 2), strides=2, padding='same')(dec2)
+    dec1 = conv_block(layers.Concatenate()([dec1, enc1]), base_filters)
+    
+    outputs = layers.Conv2D(1, (1, 1), activation='sigmoid', name='brain_mask')(dec1)
+    
+    model = models.Model(inputs, outputs)
+    model.compile(optimizer='adam', loss='binary_crossentropy')
+    return model
+
+# Model types accepted by training and skull removal
+MODEL_TYPES = ('classifier', 'unet')
+
+# Compiled Grad-CAM functions, cached per model and layer name
+_gradcam_functions = weakref.WeakKeyDictionary()
+_gradcam_lock = threading.Lock()
+
+def get_gradcam_function(model, layer_name, normalize=True):
+    """
+    Get the compiled batched Grad-CAM function for a model layer
+    
+    The gradient sub-model and its tf.function are built once per
+    (model, layer_name, normalize) and reused by every later call.
+    
+    Parameters:
+    - model: Trained CNN model
+    - layer_name: Name of the layer to use for Grad-CAM
+    - normalize: Scale each heatmap by its maximum (otherwise return raw ReLU'd maps)
+    
+    Returns:
+    - tf.function mapping (images, class_idx) to input-sized heatmaps
+    """
+    if isinstance(model, SkullModelArtifact):
+        # Exported artifacts carry the traced function
+        return model.get_gradcam_function(layer_name, normalize)
+    
+    with _gradcam_lock:
+        functions = _gradcam_functions.setdefault(model, {})
+        if (layer_name, normalize) not in functions:
+            functions[(layer_name, normalize)] = _build_gradcam_function(model, layer_name, normalize)
+        return functions[(layer_name, normalize)]
+
+def _build_gradcam_function(model, layer_name, normalize=True):
+    import tensorflow as tf
+    
+    grad_model = tf.keras.models.Model(
+        inputs=model.inputs,
+        outputs=[model.get_layer(layer_name).output, model.outputs[0]]
+    )
+    input_spec = tf.TensorSpec((None,) + tuple(model.inputs[0].shape[1:]), tf.float32)
+    
+    @tf.function(input_signature=[input_spec, tf.TensorSpec((), tf.int32)])
+    def gradcam(images, class_idx):
+        with tf.GradientTape() as tape:
+            conv_outputs, predictions = grad_model(images, training=False)
+            loss = predictions[:, class_idx]
+        
+        # Extract gradients (samples are independent, so this is per image)
+        grads = tape.gradient(loss, conv_outputs)
+        
+        # Global average pooling per image
+        pooled_grads = tf.reduce_mean(grads, axis=(1, 2), keepdims=True)
+        
+        # Weight output feature maps with gradients
+        heatmaps = tf.reduce_sum(pooled_grads * conv_outputs, axis=-1)
+        
+        # Normalize each heatmap
+        heatmaps = tf.maximum(heatmaps, 0)
+        if normalize:
+            heatmaps = heatmaps / tf.reduce_max(heatmaps, axis=(1, 2), keepdims=True)
+        
+        # Resize all heatmaps to the input image size in one op
+        heatmaps = tf.image.resize(heatmaps[..., tf.newaxis], tf.shape(images)[1:3], method='bilinear')
+        return heatmaps[..., 0]
+    
+    return gradcam
+
+def _check_input_shape(model, images):
+    # A tf.function called with inputs that do not match its signature raises
+    # without releasing its internal lock, which blocks every later call of the
+    # cached function, so mismatches are rejected before calling it
+    expected = _model_input_shape(model)
+    if images.ndim != len(expected) + 1 or any(dim is not None and dim != actual
+                                               for dim, actual in zip(expected, images.shape[1:])):
+        raise ValueError(f"Expected images of shape (N, {', '.join(map(str, expected))}), got {images.shape}")
+
+def generate_gradcam_batch(model, images, layer_name, class_idx=0, batch_size=None, normalize=True):
+    """
+    Generate Grad-CAM heatmaps for a batch of images in one forward/backward pass
+    
+    Parameters:
+    - model: Trained CNN model
+    - images: Input images, shape (N, rows, cols, channels)
+    - layer_name: Name of the layer to use for Grad-CAM
+    - class_idx: Index of the class to generate Grad-CAM for
+    - batch_size: Optional maximum number of images per pass (default: all at once)
+    - normalize: Scale each heatmap to a maximum of 1 (otherwise keep raw activations)
+    
+    Returns:
+    - Grad-CAM heatmaps, shape (N, rows, cols)
+    """
+    import tensorflow as tf
+    
+    gradcam = get_gradcam_function(model, layer_name, normalize)
+    images = np.asarray(images, dtype=np.float32)
+    _check_input_shape(model, images)
+    class_idx = tf.constant(class_idx, dtype=tf.int32)
+    
+    if batch_size is None or batch_size >= len(images):
+        return gradcam(images, class_idx).numpy()
+    
+    heatmaps = np.empty(images.shape[:3], dtype=np.float32)
+    for start in range(0, len(images), batch_size):
+        stop = start + batch_size
+        heatmaps[start:stop] = gradcam(images[start:stop], class_idx).numpy()
+    return heatmaps
+
 def generate_gradcam(model, img, layer_name, class_idx=0):
     """
     Generate Grad-CAM heatmap
@@ -43,34 +192,168 @@ def generate_gradcam(model, img, layer_name, class_idx=0):
     Returns:
     - Grad-CAM heatmap
     """
-    grad_model = tf.keras.models.Model(
-        inputs=[model.inputs],
-        outputs=[model.get_layer(layer_name).output, model.output]
-    )
+    return generate_gradcam_batch(model, img[:1], layer_name, class_idx)[0]
+
+# Compiled inference functions, cached per model
+_predict_functions = weakref.WeakKeyDictionary()
+
+def get_predict_function(model):
+    """
+    Get a compiled forward pass for a model
     
-    with tf.GradientTape() as tape:
-        conv_outputs, predictions = grad_model(img)
-        loss = predictions[:, class_idx]
+    Unlike model.predict, the tf.function is traced once per model and called
+    directly, without per-call data-adapter and callback overhead.
     
-    # Extract gradients
-    grads = tape.gradient(loss, conv_outputs)
+    Parameters:
+    - model: Trained model
     
-    # Global average pooling
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
+    Returns:
+    - tf.function mapping a float32 image batch to model outputs
+    """
+    if isinstance(model, SkullModelArtifact):
+        return model.get_predict_function()
     
-    # Weight output feature maps with gradients
-    conv_outputs = conv_outputs[0]
-    heatmap = tf.reduce_sum(tf.multiply(pooled_grads, conv_outputs), axis=-1)
+    with _gradcam_lock:
+        function = _predict_functions.get(model)
+        if function is None:
+            import tensorflow as tf
+            
+            input_spec = tf.TensorSpec((None,) + tuple(model.inputs[0].shape[1:]), tf.float32)
+            # The function is the model's value in a weak-keyed cache, so it must
+            # not hold a strong reference to the model itself
+            model_ref = weakref.ref(model)
+            
+            @tf.function(input_signature=[input_spec])
+            def predict(images):
+                return model_ref()(images, training=False)
+            
+            function = _predict_functions[model] = predict
+        return function
+
+def predict_brain_mask_batch(model, images, batch_size=None):
+    """
+    Predict brain probabilities with a segmentation model in forward passes only
     
-    # Normalize heatmap
-    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-    heatmap = heatmap.numpy()
+    Parameters:
+    - model: Trained segmentation model (see create_segmentation_unet)
+    - images: Input images, shape (N, rows, cols, channels)
+    - batch_size: Optional maximum number of images per pass (default: all at once)
     
-    # Resize heatmap to match input image size
-    heatmap = cv2.resize(heatmap, (img.shape[2], img.shape[1]))
+    Returns:
+    - Brain probabilities, shape (N, rows, cols)
+    """
+    predict = get_predict_function(model)
+    images = np.asarray(images, dtype=np.float32)
+    _check_input_shape(model, images)
+    
+    if batch_size is None or batch_size >= len(images):
+        return predict(images).numpy()[..., 0]
+    
+    probabilities = np.empty(images.shape[:3], dtype=np.float32)
+    for start in range(0, len(images), batch_size):
+        stop = start + batch_size
+        probabilities[start:stop] = predict(images[start:stop]).numpy()[..., 0]
+    return probabilities
+
+def _model_input_shape(model):
+    # Input shape without the batch axis, for Keras models and exported artifacts
+    if isinstance(model, SkullModelArtifact):
+        return model.input_shape
+    return tuple(model.inputs[0].shape[1:])
+
+def _tile_origins(length, tile_size, stride):
+    """
+    Start offsets of tiles covering [0, length); the last tile is aligned to the end
+    """
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def _blend_window(tile_size, overlap):
+    """
+    2D blending weights: 1 in the tile centre, ramping down linearly across the overlap
+    """
+    ramp = np.minimum(1.0, (np.arange(tile_size) + 1.0) / (overlap + 1.0))
+    ramp = np.minimum(ramp, ramp[::-1]).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+def generate_gradcam_tiled(model, image, layer_name, class_idx=0, tile_size=None, overlap=32, batch_size=8):
+    """
+    Generate a full-resolution Grad-CAM heatmap from overlapping tiles
+    
+    Instead of squashing the whole image to the CNN input size, the image is cut
+    into overlapping tiles that are run through the CNN and Grad-CAM in batches.
+    The raw tile heatmaps are blended with linear ramps across the overlaps and
+    normalized once over the whole image. Memory is bounded by batch_size tiles.
+    
+    Parameters:
+    - model: Trained CNN model
+    - image: Normalized input image (rows, cols, channels)
+    - layer_name: Name of the layer to use for Grad-CAM
+    - class_idx: Index of the class to generate Grad-CAM for
+    - tile_size: Tile edge in pixels (default: the model input size); tiles of
+      another size are resized to the model input
+    - overlap: Overlap between neighbouring tiles in pixels
+    - batch_size: Number of tiles per Grad-CAM pass
     
+    Returns:
+    - Grad-CAM heatmap, shape (rows, cols)
+    """
+    model_rows, model_cols = _model_input_shape(model)[:2]
+    if tile_size is None:
+        tile_size = model_rows
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"Tile overlap must be in [0, {tile_size}), got {overlap}")
+    
+    rows, cols, channels = image.shape
+    
+    # Images smaller than a tile are zero-padded (background)
+    padded_rows, padded_cols = max(rows, tile_size), max(cols, tile_size)
+    if (padded_rows, padded_cols) != (rows, cols):
+        padded = np.zeros((padded_rows, padded_cols, channels), dtype=np.float32)
+        padded[:rows, :cols] = image
+        image = padded
+    
+    stride = tile_size - overlap
+    origins = [(y, x) for y in _tile_origins(padded_rows, tile_size, stride)
+               for x in _tile_origins(padded_cols, tile_size, stride)]
+    
+    window = _blend_window(tile_size, overlap)
+    accumulated = np.zeros((padded_rows, padded_cols), dtype=np.float32)
+    weights = np.zeros((padded_rows, padded_cols), dtype=np.float32)
+    
+    resize_tiles = (tile_size, tile_size) != (model_rows, model_cols)
+    batch = np.empty((min(batch_size, len(origins)), model_rows, model_cols, channels), dtype=np.float32)
+    
+    for start in range(0, len(origins), batch_size):
+        batch_origins = origins[start:start + batch_size]
+        for i, (y, x) in enumerate(batch_origins):
+            tile = image[y:y + tile_size, x:x + tile_size]
+            if resize_tiles:
+                tile = cv2.resize(np.asarray(tile, dtype=np.float32), (model_cols, model_rows)).reshape(batch.shape[1:])
+            batch[i] = tile
+        
+        # Raw (unnormalized) maps, so tiles stay comparable after blending
+        heatmaps = generate_gradcam_batch(model, batch[:len(batch_origins)], layer_name, class_idx, normalize=False)
+        
+        for heatmap, (y, x) in zip(heatmaps, batch_origins):
+            if resize_tiles:
+                heatmap = cv2.resize(heatmap, (tile_size, tile_size))
+            accumulated[y:y + tile_size, x:x + tile_size] += heatmap * window
+            weights[y:y + tile_size, x:x + tile_size] += window
+    
+    heatmap = accumulated[:rows, :cols]
+    heatmap /= weights[:rows, :cols]
+    
+    # Normalize once over the whole image
+    heatmap_max = heatmap.max()
+    if heatmap_max > 0:
+        heatmap /= heatmap_max
     return heatmap
 
+@profiled('train.fit')
 def train_skull_brain_model(images, masks, epochs=10):
     """
     Train a simple CNN to differentiate between skull and brain regions
@@ -84,8 +367,11 @@ def train_skull_brain_model(images, masks, epochs=10):
     """
     # Prepare data
     X = np.array(images)
-    y = np.array([mask.astype(np.float32) for mask in masks])
-    y = np.stack([1 - y, y], axis=-1)  # One-hot encode: [brain, skull]
+    
+    # The classifier predicts one [brain, skull] pair per image, so each mask
+    # becomes its skull fraction (a soft image-level label)
+    skull_fraction = np.array([np.mean(mask, dtype=np.float32) for mask in masks])
+    y = np.stack([1 - skull_fraction, skull_fraction], axis=-1)
     
     # Create and train model
     input_shape = X[0].shape
@@ -94,21 +380,59 @@ def train_skull_brain_model(images, masks, epochs=10):
     
     return model
 
-def skull_removal_with_gradcam(image, pretrained_model=None):
+def _classifier_targets(brain_masks):
     """
-    Advanced skull removal technique using Grad-CAM for hyperspectral brain images
+    Image-level [brain, skull] targets from a batch of brain masks
+    """
+    brain_fraction = brain_masks.mean(axis=(1, 2), dtype=np.float32)
+    return np.stack([brain_fraction, 1 - brain_fraction], axis=-1)
+
+def _segmentation_targets(brain_masks):
+    """
+    Per-pixel brain targets, shaped like the U-Net output
+    """
+    return brain_masks.astype(np.float32)[..., np.newaxis]
+
+@profiled('train.fit')
+def train_skull_brain_model_on_batches(augmenter, epochs=10, model_type='classifier'):
+    """
+    Train the skull/brain model on batches streamed from a SyntheticAugmenter
+    
+    Batches are built by a parallel tf.data pipeline while the model trains, so
+    the augmented samples never need to be held in memory at once.
     
     Parameters:
-    - image: Input hyperspectral brain image
-    - pretrained_model: Optional pretrained CNN model for Grad-CAM
+    - augmenter: augmentation.SyntheticAugmenter producing (images, brain masks) batches;
+      masks must have the image's rows and cols
+    - epochs: Number of training epochs
+    - model_type: 'classifier' (CNN for Grad-CAM) or 'unet' (segmentation model)
     
     Returns:
-    - Skull-removed brain image and brain mask
+    - Trained model
     """
-    # Check image dimensions
-    if len(image.shape) < 3:
-        raise ValueError("Image should be a 3D hyperspectral array")
+    if model_type == 'unet':
+        model = create_segmentation_unet(augmenter.image.shape)
+        label_fn = _segmentation_targets
+    elif model_type == 'classifier':
+        model = create_simple_cnn(augmenter.image.shape)
+        label_fn = _classifier_targets
+    else:
+        raise ValueError(f"Unsupported model type: {model_type}")
+    
+    model.fit(augmenter.as_dataset(label_fn=label_fn), epochs=epochs, verbose=1)
+    
+    return model
+
+def prepare_cnn_input(image):
+    """
+    Prepare a hyperspectral image for the CNN
     
+    Parameters:
+    - image: Input hyperspectral brain image
+    
+    Returns:
+    - Normalized CNN input with batch dimension and average intensity projection
+    """
     # Create average intensity projection for visualization
     avg_intensity = np.mean(image, axis=-1)
     
@@ -122,91 +446,441 @@ def skull_removal_with_gradcam(image, pretrained_model=None):
         cnn_input = cv2.resize(avg_intensity, (224, 224))[..., np.newaxis]
         cnn_input = np.expand_dims(cnn_input, axis=0)
     
-    # Normalize input
-    cnn_input = (cnn_input - cnn_input.min()) / (cnn_input.max() - cnn_input.min())
+    # Normalize input in place (cnn_input is a fresh array; integer inputs are
+    # promoted to float64 first, as the out-of-place arithmetic did)
+    if not np.issubdtype(cnn_input.dtype, np.floating):
+        cnn_input = cnn_input.astype(np.float64)
+    input_min = cnn_input.min()
+    input_range = cnn_input.max() - input_min
+    cnn_input -= input_min
+    cnn_input /= input_range
     
-    # If no pretrained model, use traditional methods first to create a simple model
-    if pretrained_model is None:
-        # Apply traditional methods to get an initial mask
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply((avg_intensity * 255).astype(np.uint8))
+    return cnn_input, avg_intensity
+
+def mask_bounding_box(mask):
+    """
+    Bounding box of the True pixels of a 2D mask
+    
+    Parameters:
+    - mask: Boolean mask (rows, cols)
+    
+    Returns:
+    - (row_slice, col_slice), or empty slices if the mask is empty
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return slice(0, 0), slice(0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+def apply_brain_mask(image, mask, out=None, crop=False):
+    """
+    Zero everything outside the brain mask in a single broadcast multiply
+    
+    Parameters:
+    - image: Input image (rows, cols, bands)
+    - mask: Boolean brain mask (rows, cols)
+    - out: Optional preallocated output (e.g. a memory map); its shape is the
+      cropped shape when crop is set. May be image itself to mask in place.
+    - crop: Return only the bounding box of the brain region
+    
+    Returns:
+    - Masked image (full size, or the bounding-box region when crop is set)
+    """
+    if crop:
+        row_slice, col_slice = mask_bounding_box(mask)
+        image = image[row_slice, col_slice]
+        mask = mask[row_slice, col_slice]
+    
+    # The mask is broadcast across bands, so there is no per-band loop or zero fill
+    return np.multiply(image, mask[..., np.newaxis], out=out)
+
+# CLAHE objects are reused across calls, one per thread (they are not thread-safe)
+_clahe_local = threading.local()
+
+# Structuring element for the morphological clean-up
+_MORPH_KERNEL = np.ones((5, 5), np.uint8)
+
+def _get_clahe():
+    clahe = getattr(_clahe_local, 'clahe', None)
+    if clahe is None:
+        clahe = _clahe_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe
+
+@profiled('mask.clahe_otsu')
+def otsu_brain_mask(avg_intensity, out=None):
+    """
+    Traditional brain region: CLAHE contrast enhancement followed by Otsu thresholding
+    
+    Parameters:
+    - avg_intensity: Average intensity projection in [0, 1], (rows, cols) or a stack (N, rows, cols)
+    - out: Optional preallocated boolean output of the same shape
+    
+    Returns:
+    - Boolean brain mask (thresholded per slice for stacks)
+    """
+    from skimage import filters
+    
+    if out is None:
+        out = np.empty(avg_intensity.shape, dtype=bool)
+    
+    slices = avg_intensity if avg_intensity.ndim == 3 else avg_intensity[np.newaxis]
+    out_slices = out if out.ndim == 3 else out[np.newaxis]
+    
+    # Scratch buffers are shared by all slices
+    clahe = _get_clahe()
+    scaled = np.empty(slices.shape[1:], dtype=np.result_type(slices.dtype, np.float32))
+    image_u8 = np.empty(slices.shape[1:], dtype=np.uint8)
+    enhanced = np.empty(slices.shape[1:], dtype=np.uint8)
+    
+    for intensity, mask in zip(slices, out_slices):
+        np.multiply(intensity, 255, out=scaled)
+        np.copyto(image_u8, scaled, casting='unsafe')
+        clahe.apply(image_u8, enhanced)
         
         otsu_thresh = filters.threshold_otsu(enhanced)
-        initial_mask = enhanced > otsu_thresh
+        np.greater(enhanced, otsu_thresh, out=mask)
+    
+    return out
+
+@profiled('mask.refine')
+def refine_mask(mask, out=None):
+    """
+    Clean up a binary mask with small object/hole removal and morphological closing/opening
+    
+    Parameters:
+    - mask: Boolean mask, (rows, cols) or a stack (N, rows, cols)
+    - out: Optional boolean output of the same shape (may be mask itself to work in place)
+    
+    Returns:
+    - Refined boolean mask (refined per slice for stacks)
+    """
+    from skimage import morphology
+    
+    if out is None:
+        out = np.empty(mask.shape, dtype=bool)
+    
+    slices = mask if mask.ndim == 3 else mask[np.newaxis]
+    out_slices = out if out.ndim == 3 else out[np.newaxis]
+    
+    for mask_slice, refined in zip(slices, out_slices):
+        morphology.remove_small_objects(mask_slice, min_size=500, out=refined)
+        morphology.remove_small_holes(refined, area_threshold=1000, out=refined)
         
-        cleaned_mask = morphology.remove_small_objects(initial_mask, min_size=500)
-        cleaned_mask = morphology.remove_small_holes(cleaned_mask, area_threshold=1000)
+        # Boolean buffers are viewed as 0/1 uint8 for OpenCV, without copying
+        refined_u8 = refined.view(np.uint8)
+        cv2.morphologyEx(refined_u8, cv2.MORPH_CLOSE, _MORPH_KERNEL, dst=refined_u8)
+        cv2.morphologyEx(refined_u8, cv2.MORPH_OPEN, _MORPH_KERNEL, dst=refined_u8)
+    
+    return out
+
+def traditional_brain_mask(avg_intensity, out=None):
+    """
+    Fast brain mask without the CNN: CLAHE, Otsu thresholding and morphological refinement
+    
+    Parameters:
+    - avg_intensity: Average intensity projection in [0, 1], (rows, cols) or a stack (N, rows, cols)
+    - out: Optional preallocated boolean output of the same shape
+    
+    Returns:
+    - Boolean brain mask
+    """
+    mask = otsu_brain_mask(avg_intensity, out=out)
+    return refine_mask(mask, out=mask)
+
+def train_model_from_image(cnn_input, avg_intensity, epochs=5, initial_mask=None, n_augmented=5, batch_size=4,
+                           seed=None, model_type='classifier'):
+    """
+    Train a skull/brain model from a single image using traditional masks and augmentation
+    
+    Parameters:
+    - cnn_input: Normalized CNN input with batch dimension (see prepare_cnn_input)
+    - avg_intensity: Average intensity projection of the original image
+    - epochs: Number of training epochs
+    - initial_mask: Optional precomputed otsu_brain_mask of avg_intensity
+    - n_augmented: Number of noised and rotated training samples
+    - batch_size: Training batch size
+    - seed: Optional random seed for the augmentation
+    - model_type: 'classifier' (CNN for Grad-CAM) or 'unet' (segmentation model)
+    
+    Returns:
+    - Trained model
+    """
+    from augmentation import SyntheticAugmenter
+    
+    # Apply traditional methods to get an initial mask
+    if initial_mask is None:
+        initial_mask = otsu_brain_mask(avg_intensity)
+    refined_mask = refine_mask(initial_mask)
+    
+    # Bring the mask to the CNN input size, so masks and images line up
+    cnn_rows, cnn_cols = cnn_input.shape[1:3]
+    refined_mask = cv2.resize(refined_mask.view(np.uint8), (cnn_cols, cnn_rows), interpolation=cv2.INTER_NEAREST)
+    
+    # Synthetic training data: the image itself plus noised, rotated variations,
+    # generated batch by batch with affine warps while the model trains
+    augmenter = SyntheticAugmenter(cnn_input[0], refined_mask, n_samples=n_augmented, batch_size=batch_size,
+                                   seed=seed)
+    
+    # Train a simple model
+    return train_skull_brain_model_on_batches(augmenter, epochs=epochs, model_type=model_type)
+
+def warm_skull_model(image, model_registry, model_type='classifier'):
+    """
+    Train (or load) the model for an image's input shape once, ahead of inference
+    
+    Parameters:
+    - image: Representative hyperspectral brain image
+    - model_registry: ModelRegistry that stores the trained model
+    - model_type: 'classifier' or 'unet'
+    
+    Returns:
+    - Trained model registered for the image's input shape
+    """
+    if len(image.shape) < 3:
+        raise ValueError("Image should be a 3D hyperspectral array")
+    
+    cnn_input, avg_intensity = prepare_cnn_input(image)
+    return model_registry.get_or_train(
+        cnn_input.shape[1:],
+        lambda: train_model_from_image(cnn_input, avg_intensity, model_type=model_type),
+        variant=_registry_variant(model_type)
+    )
+
+def _registry_variant(model_type):
+    # Classifiers keep the original registry keys
+    return None if model_type == 'classifier' else model_type
+
+@profiled('skull_removal')
+def skull_removal_with_gradcam(image, pretrained_model=None, model_registry=None, heatmap_threshold=0.5, cache=None, use_cnn=True,
+                               gradcam_fn=None, dtype=None, gradcam_mode='resize', tile_size=None, tile_overlap=32,
+                               tile_batch_size=8, model_type='classifier', out=None, crop=False):
+    """
+    Advanced skull removal technique using Grad-CAM for hyperspectral brain images
+    
+    Parameters:
+    - image: Input hyperspectral brain image
+    - pretrained_model: Optional pretrained CNN model for Grad-CAM, or the path of an
+      exported artifact (see export_skull_model), which is loaded once per process
+      and whose model type overrides model_type
+    - model_registry: Optional ModelRegistry used to reuse models trained for the same input shape
+    - heatmap_threshold: Grad-CAM activation above which a pixel is treated as skull
+    - cache: Optional ArrayCache for the traditional mask, Grad-CAM map and brain mask;
+      on a Grad-CAM cache hit without a pretrained or registered model, no model is
+      trained and None is returned in its place
+    - use_cnn: If False, skip the CNN and Grad-CAM entirely and use the traditional
+      mask (fast path); the heatmap and model are returned as None
+    - gradcam_fn: Optional callable (model, cnn_input) returning the skull-class Grad-CAM
+      heatmap at CNN input size, e.g. to batch Grad-CAM across concurrent requests
+    - dtype: Optional working float dtype; with np.float32 the image is converted once
+      and every intermediate (CNN input, projections, masked output) stays float32
+    - gradcam_mode: 'resize' runs Grad-CAM on the image squashed to the CNN input size
+      and upsamples the heatmap; 'tiled' runs it on overlapping full-resolution tiles
+      and blends them (see generate_gradcam_tiled); gradcam_fn only applies to 'resize'
+    - tile_size, tile_overlap, tile_batch_size: Tiling options for the 'tiled' mode
+    - model_type: 'classifier' locates the skull with Grad-CAM on the CNN; 'unet'
+      predicts the brain mask with a segmentation model in a single forward pass
+      (no gradient tape) and uses 1 - brain probability as the skull heatmap
+    - out: Optional preallocated output for the skull-removed image (see apply_brain_mask)
+    - crop: Return the skull-removed image cropped to the brain's bounding box
+      (the mask stays full size; mask_bounding_box(mask) gives the crop offsets)
+    
+    Returns:
+    - Skull-removed brain image and brain mask
+    """
+    # Check image dimensions
+    if len(image.shape) < 3:
+        raise ValueError("Image should be a 3D hyperspectral array")
+    if gradcam_mode not in ('resize', 'tiled'):
+        raise ValueError(f"Unsupported Grad-CAM mode: {gradcam_mode}")
+    if isinstance(pretrained_model, (str, os.PathLike)):
+        pretrained_model = load_skull_model(pretrained_model)
+    if isinstance(pretrained_model, SkullModelArtifact):
+        model_type = pretrained_model.model_type
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Unsupported model type: {model_type}")
+    if model_type == 'unet' and gradcam_mode != 'resize':
+        raise ValueError("The U-Net model only supports gradcam_mode='resize'")
+    
+    if dtype is not None:
+        image = np.asarray(image, dtype=dtype)
+    
+    with stage('skull_removal.prepare_cnn_input') as current:
+        cnn_input, avg_intensity = prepare_cnn_input(image)
+        current.arrays_used(image=image, cnn_input=cnn_input)
+    input_key = cache.content_key(image) if cache is not None else None
+    
+    def cached(stage_key, compute_fn):
+        if cache is None:
+            return compute_fn()
+        return cache.get_or_compute(stage_key, compute_fn)
+    
+    # Traditional brain region, shared by model training and mask combination
+    traditional_key = cache.key(input_key, 'traditional_mask') if cache is not None else None
+    traditional_mask = cached(traditional_key, lambda: otsu_brain_mask(avg_intensity))
+    
+    if not use_cnn:
+        mask_key = cache.key(traditional_key, 'refined_mask') if cache is not None else None
+        final_brain_mask = cached(mask_key, lambda: refine_mask(traditional_mask))
+        return apply_brain_mask(image, final_brain_mask, out=out, crop=crop), final_brain_mask, None, None
+    
+    def train():
+        return train_model_from_image(cnn_input, avg_intensity, initial_mask=traditional_mask, model_type=model_type)
+    
+    # If no pretrained model, use traditional methods first to create a simple model
+    model = pretrained_model
+    if model is None and model_registry is not None:
+        # Reuse the model trained for this input shape and band count, if any
+        model = model_registry.get_or_train(cnn_input.shape[1:], train, variant=_registry_variant(model_type))
+    
+    def compute_gradcam():
+        nonlocal model
+        if model is None:
+            model = train()
         
-        kernel = np.ones((5, 5), np.uint8)
-        refined_mask = cv2.morphologyEx(cleaned_mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
-        refined_mask = cv2.morphologyEx(refined_mask, cv2.MORPH_OPEN, kernel)
+        if model_type == 'unet':
+            # Skull probability straight from the segmentation output
+            skull_probability = 1 - predict_brain_mask_batch(model, cnn_input)[0]
+            return cv2.resize(skull_probability, (avg_intensity.shape[1], avg_intensity.shape[0]))
         
-        # Generate synthetic training data
-        synthetic_images = []
-        synthetic_masks = []
+        # Generate Grad-CAM heatmap for skull class (class_idx=1)
+        if gradcam_mode == 'tiled':
+            # Full-resolution tiles, normalized like the CNN input
+            full_input = np.array(image, dtype=np.float32)
+            full_input -= full_input.min()
+            full_input /= full_input.max()
+            return generate_gradcam_tiled(model, full_input, "final_conv", class_idx=1, tile_size=tile_size,
+                                          overlap=tile_overlap, batch_size=tile_batch_size)
+        if gradcam_fn is not None:
+            gradcam_heatmap = gradcam_fn(model, cnn_input)
+        else:
+            gradcam_heatmap = generate_gradcam(model, cnn_input, "final_conv", class_idx=1)
         
-        # Use the initial refined mask as a training example
-        synthetic_images.append(cnn_input[0])
-        synthetic_masks.append(refined_mask)
+        # Resize heatmap to original image size
+        return cv2.resize(gradcam_heatmap, (avg_intensity.shape[1], avg_intensity.shape[0]))
+    
+    gradcam_key = None
+    if cache is not None:
+        model_id = hash_model(model) if model is not None else 'self-trained'
+        tiling = {}
+        if gradcam_mode == 'tiled':
+            tiling = {'tile_size': tile_size, 'tile_overlap': tile_overlap}
+        if model_type == 'unet':
+            gradcam_key = cache.key(input_key, 'segmentation', model=model_id)
+        else:
+            gradcam_key = cache.key(input_key, 'gradcam', model=model_id, layer_name='final_conv', class_idx=1, **tiling)
+    stage_name = 'skull_removal.segmentation' if model_type == 'unet' else 'skull_removal.gradcam'
+    with stage(stage_name, mode=gradcam_mode) as current:
+        original_size_heatmap = cached(gradcam_key, compute_gradcam)
+        current.arrays_used(heatmap=original_size_heatmap)
+    
+    def compute_brain_mask():
+        # Threshold the heatmap to create a mask
+        # Higher values indicate higher activation for skull class
+        brain_mask = original_size_heatmap > heatmap_threshold
         
-        # Add more synthetic examples with variations
-        for _ in range(5):
-            # Apply random noise and transformations for data augmentation
-            noise = np.random.normal(0, 0.1, cnn_input[0].shape)
-            noisy_img = cnn_input[0] + noise
-            noisy_img = np.clip(noisy_img, 0, 1)
-            
-            # Apply random rotation
-            angle = np.random.randint(-20, 20)
-            rotated_img = ndimage.rotate(noisy_img, angle, reshape=False)
-            rotated_mask = ndimage.rotate(refined_mask, angle, reshape=False)
-            
-            synthetic_images.append(rotated_img)
-            synthetic_masks.append(rotated_mask > 0.5)
+        # Combine masks (intersection of traditional brain region and inverse of Grad-CAM skull region)
+        np.logical_not(brain_mask, out=brain_mask)
+        np.logical_and(brain_mask, traditional_mask, out=brain_mask)
         
-        # Train a simple model
-        model = train_skull_brain_model(synthetic_images, synthetic_masks, epochs=5)
-    else:
-        model = pretrained_model
+        # Apply morphological operations to clean up the mask
+        return refine_mask(brain_mask, out=brain_mask)
     
-    # Generate Grad-CAM heatmap for skull class (class_idx=1)
-    gradcam_heatmap = generate_gradcam(model, cnn_input, "final_conv", class_idx=1)
+    mask_key = cache.key(gradcam_key, 'brain_mask', heatmap_threshold=heatmap_threshold) if cache is not None else None
+    with stage('skull_removal.brain_mask'):
+        final_brain_mask = cached(mask_key, compute_brain_mask)
     
-    # Resize heatmap to original image size
-    original_size_heatmap = cv2.resize(gradcam_heatmap, (avg_intensity.shape[1], avg_intensity.shape[0]))
+    # Apply mask to original image
+    with stage('skull_removal.apply_mask') as current:
+        brain_only = apply_brain_mask(image, final_brain_mask, out=out, crop=crop)
+        current.arrays_used(output=brain_only)
     
-    # Threshold the heatmap to create a mask
-    # Higher values indicate higher activation for skull class
-    heatmap_threshold = 0.5  # Adjust based on your needs
-    skull_mask = original_size_heatmap > heatmap_threshold
+    return brain_only, final_brain_mask, original_size_heatmap, model
+
+def skull_removal_batch(images, model_registry=None):
+    """
+    Run skull removal over many images, training each model once per input shape
     
-    # Combine with traditional method for better results
-    # Apply traditional methods to get an additional mask
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply((avg_intensity * 255).astype(np.uint8))
+    Parameters:
+    - images: Iterable of hyperspectral brain images
+    - model_registry: Optional ModelRegistry (default: an in-memory registry for this batch)
     
+    Returns:
+    - List of skull_removal_with_gradcam results, one per image
+    """
+    if model_registry is None:
+        from model_registry import ModelRegistry
+        model_registry = ModelRegistry(cache_dir=None)
+    
+    return [skull_removal_with_gradcam(image, model_registry=model_registry) for image in images]
+
+def skull_removal_volume(volume, enhance=True, min_size=5000, area_threshold=10000, keep_largest=True):
+    """
+    Volumetric skull removal for MRI volumes, processed as one 3D array
+    
+    Intensity normalization and the Otsu threshold are computed once for the
+    whole volume, and the clean-up uses 3D connectivity and 3D morphology, so
+    the mask is consistent across slices.
+    
+    Parameters:
+    - volume: Input volume, (rows, cols, depth) or (rows, cols, depth, bands)
+    - enhance: Apply CLAHE contrast enhancement to each axial slice before thresholding
+    - min_size: Minimum connected component size in voxels
+    - area_threshold: Maximum hole size in voxels to fill
+    - keep_largest: Keep only the largest connected component as the brain
+    
+    Returns:
+    - Skull-removed volume and brain mask of shape (rows, cols, depth)
+    """
+    import scipy.ndimage as ndimage
+    from skimage import filters, morphology
+    
+    if volume.ndim not in (3, 4):
+        raise ValueError("Volume should be a (rows, cols, depth) or (rows, cols, depth, bands) array")
+    
+    # Intensity projection over bands, with slices first for contiguous per-slice access
+    intensity = np.mean(volume, axis=-1) if volume.ndim == 4 else volume
+    intensity = np.ascontiguousarray(np.transpose(intensity, (2, 0, 1)), dtype=np.float32)
+    
+    # Normalize once per volume
+    low, high = intensity.min(), intensity.max()
+    intensity -= low
+    intensity *= 255.0 / (high - low)
+    enhanced = intensity.astype(np.uint8)
+    
+    if enhance:
+        clahe = _get_clahe()
+        for slice_u8 in enhanced:
+            clahe.apply(slice_u8, slice_u8)
+    
+    # A single Otsu threshold for the whole volume
     otsu_thresh = filters.threshold_otsu(enhanced)
-    traditional_mask = enhanced > otsu_thresh
+    mask = enhanced > otsu_thresh
     
-    # Combine masks (intersection of traditional brain region and inverse of Grad-CAM skull region)
-    combined_skull_mask = np.logical_or(skull_mask, ~traditional_mask)
-    brain_mask = ~combined_skull_mask
+    # 3D clean-up: components and holes use 3D connectivity
+    morphology.remove_small_objects(mask, min_size=min_size, out=mask)
+    morphology.remove_small_holes(mask, area_threshold=area_threshold, out=mask)
     
-    # Apply morphological operations to clean up the mask
-    cleaned_mask = morphology.remove_small_objects(brain_mask, min_size=500)
-    cleaned_mask = morphology.remove_small_holes(cleaned_mask, area_threshold=1000)
+    structure = np.ones((3, 5, 5), dtype=bool)  # (depth, rows, cols)
+    mask = ndimage.binary_closing(mask, structure=structure)
+    mask = ndimage.binary_opening(mask, structure=structure)
     
-    kernel = np.ones((5, 5), np.uint8)
-    final_brain_mask = cv2.morphologyEx(cleaned_mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
-    final_brain_mask = cv2.morphologyEx(final_brain_mask, cv2.MORPH_OPEN, kernel)
-    final_brain_mask = final_brain_mask.astype(bool)
+    if keep_largest:
+        labels, n_labels = ndimage.label(mask)
+        if n_labels > 1:
+            sizes = np.bincount(labels.ravel())
+            sizes[0] = 0
+            mask = labels == sizes.argmax()
     
-    # Apply mask to original image
-    brain_only = np.zeros_like(image)
-    for i in range(image.shape[-1]):
-        brain_only[..., i] = image[..., i] * final_brain_mask
+    # Back to (rows, cols, depth)
+    brain_mask = np.transpose(mask, (1, 2, 0))
     
-    return brain_only, final_brain_mask, original_size_heatmap, model
+    if volume.ndim == 4:
+        brain_only = volume * brain_mask[..., np.newaxis]
+    else:
+        brain_only = volume * brain_mask
+    
+    return brain_only, brain_mask
 
 def visualize_skull_removal_with_gradcam(original_image, brain_only_image, brain_mask, gradcam_heatmap):
     """
@@ -218,6 +892,8 @@ def visualize_skull_removal_with_gradcam(original_image, brain_only_image, brain
     - brain_mask: Binary mask of brain region
     - gradcam_heatmap: Grad-CAM heatmap
     """
+    import matplotlib.pyplot as plt
+    
     plt.figure(figsize=(15, 10))
     
     # Original Average Intensity
@@ -245,6 +921,8 @@ def visualize_skull_removal_with_gradcam(original_image, brain_only_image, brain
     plt.show()
 
 def main():
+    import matplotlib.pyplot as plt
+    
     # Option 1: Load from file (replace with your image loading method)
     # image = np.load('your_hyperspectral_image.npy')
     
@@ -270,5 +948,6 @@ def main():
 if __name__ == "__main__":
     brain_image, mask, trained_model = main()
     
-    # Save model for future use
-    # trained_model.save('skull_brain_model.h5')
\ No newline at end of file
+    # Save model for future use; pass the path as pretrained_model to skip training
+    # from skull_model_artifact import export_skull_model
+    # export_skull_model(trained_model, 'skull_brain_model')
\ No newline at end of file
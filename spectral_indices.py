@@ -0,0 +1,249 @@
+import ast
+import re
+import threading
+
+import numpy as np
+
+# Built-in indices as band-arithmetic expressions; bK is band K of the cube
+SPECTRAL_INDICES = {
+    # Example: Near-infrared (band 3) and Red (band 2) bands (adjust indices as needed)
+    'ndvi': '(b3 - b2) / (b3 + b2)',
+    # Example formula (to be replaced with actual tumor detection formula)
+    'tumor': '(b0 + b1) / (b2 + 1e-10)',
+}
+
+# Value substituted for zero denominators
+SAFE_DIVISION_EPSILON = 1e-10
+
+# Pixels evaluated per tile, so temporaries stay cache-sized
+_TILE_PIXELS = 1 << 16
+
+_BAND_NAME = re.compile(r'^b(\d+)$')
+
+_BINARY_UFUNCS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+
+_UNARY_UFUNCS = {
+    ast.USub: np.negative,
+}
+
+_FUNCTIONS = {
+    'abs': np.absolute,
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+}
+
+
+class CompiledIndex:
+    def __init__(self, expression):
+        """
+        Compile a band-arithmetic expression into a chain of ufunc calls
+
+        Supported syntax: band names b0, b1, ..., numbers, + - * / **, unary minus
+        and abs/sqrt/log/exp. Division is safe: zero denominators are replaced
+        with SAFE_DIVISION_EPSILON.
+
+        Parameters:
+        - expression: Expression string, e.g. '(b3 - b2) / (b3 + b2)'
+        """
+        self.expression = expression
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as error:
+            raise ValueError(f"Invalid spectral index expression: {expression}") from error
+
+        # Each instruction is (ufunc, operands, destination register); operands are
+        # ('band', k), ('const', value) or ('reg', i). The last instruction writes
+        # to register -1, which is the caller's output.
+        self.instructions = []
+        self.n_registers = 0
+        self._free_registers = []
+        result = self._compile(tree.body)
+
+        if result[0] != 'reg':
+            # A bare band or constant: copy it into the output
+            self.instructions.append((np.positive, (result,), -1))
+        else:
+            ufunc, operands, _ = self.instructions[-1]
+            self.instructions[-1] = (ufunc, operands, -1)
+        del self._free_registers
+
+        self.bands = sorted({operand[1] for _, operands, _ in self.instructions
+                             for operand in operands if operand[0] == 'band'})
+        self.min_bands = self.bands[-1] + 1 if self.bands else 0
+
+    def _allocate(self, operands):
+        # Reuse a register consumed by this instruction, or a freed one
+        for operand in operands:
+            if operand[0] == 'reg':
+                for other in operands:
+                    if other[0] == 'reg' and other is not operand:
+                        self._free_registers.append(other[1])
+                return operand[1]
+        if self._free_registers:
+            return self._free_registers.pop()
+        self.n_registers += 1
+        return self.n_registers - 1
+
+    def _emit(self, ufunc, operands):
+        if all(operand[0] == 'const' for operand in operands):
+            # Fold constant subexpressions at compile time
+            values = [operand[1] for operand in operands]
+            if ufunc is np.divide and values[1] == 0:
+                values[1] = SAFE_DIVISION_EPSILON
+            return ('const', float(ufunc(*values)))
+
+        if ufunc is np.divide and operands[1][0] == 'const' and operands[1][1] == 0:
+            operands = (operands[0], ('const', SAFE_DIVISION_EPSILON))
+        elif ufunc is np.divide and operands[1][0] != 'const':
+            # The denominator must live in a register so zeros can be replaced in place
+            denominator = operands[1]
+            if denominator[0] == 'band':
+                denominator = ('reg', self._allocate(()))
+                self.instructions.append((np.positive, (operands[1],), denominator[1]))
+            operands = (operands[0], denominator)
+            ufunc = _safe_divide
+
+        destination = self._allocate(operands)
+        self.instructions.append((ufunc, operands, destination))
+        return ('reg', destination)
+
+    def _compile(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_UFUNCS:
+            left = self._compile(node.left)
+            right = self._compile(node.right)
+            return self._emit(_BINARY_UFUNCS[type(node.op)], (left, right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_UFUNCS:
+            return self._emit(_UNARY_UFUNCS[type(node.op)], (self._compile(node.operand),))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand)
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS
+                and len(node.args) == 1 and not node.keywords):
+            return self._emit(_FUNCTIONS[node.func.id], (self._compile(node.args[0]),))
+        if isinstance(node, ast.Name):
+            match = _BAND_NAME.match(node.id)
+            if match is None:
+                raise ValueError(f"Unknown name in spectral index expression: {node.id}")
+            return ('band', int(match.group(1)))
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return ('const', float(node.value))
+        raise ValueError(f"Unsupported syntax in spectral index expression: {ast.dump(node)}")
+
+    def evaluate_tile(self, tile, out, registers):
+        """
+        Evaluate the expression over one tile
+
+        Parameters:
+        - tile: Input cube tile (rows, cols, bands)
+        - out: Output array (rows, cols)
+        - registers: Preallocated temporaries, at least n_registers arrays shaped like out
+        """
+        for ufunc, operands, destination in self.instructions:
+            args = []
+            for kind, value in operands:
+                if kind == 'band':
+                    args.append(tile[:, :, value])
+                elif kind == 'const':
+                    args.append(value)
+                else:
+                    args.append(registers[value])
+            target = out if destination == -1 else registers[destination]
+            # Computing in the output dtype avoids integer wrap-around on raw cubes
+            ufunc(*args, out=target, dtype=target.dtype)
+        return out
+
+
+def _safe_divide(numerator, denominator, out, dtype=None):
+    # Avoid division by zero; the denominator is always a scratch register
+    denominator[denominator == 0] = SAFE_DIVISION_EPSILON
+    return np.divide(numerator, denominator, out=out, dtype=dtype)
+
+
+class SpectralIndexRegistry:
+    def __init__(self, indices=None):
+        """
+        Registry of named spectral indices compiled on first use
+
+        Parameters:
+        - indices: Optional {name: expression} mapping (default: SPECTRAL_INDICES)
+        """
+        self._expressions = dict(SPECTRAL_INDICES if indices is None else indices)
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, expression):
+        """
+        Add or replace a named index; the expression is validated immediately
+        """
+        compiled = CompiledIndex(expression)
+        with self._lock:
+            self._expressions[name] = expression
+            self._compiled[name] = compiled
+
+    def names(self):
+        return list(self._expressions)
+
+    def __contains__(self, name):
+        return name in self._expressions
+
+    def get(self, name):
+        """
+        Compiled index for a registered name
+        """
+        with self._lock:
+            compiled = self._compiled.get(name)
+            if compiled is None:
+                if name not in self._expressions:
+                    raise ValueError(f"Unsupported index type: {name}")
+                compiled = self._compiled[name] = CompiledIndex(self._expressions[name])
+            return compiled
+
+    def evaluate(self, hyperspectral_image, names, out=None, dtype=None, tile_rows=None):
+        """
+        Evaluate several indices in a single pass over the cube
+
+        Parameters:
+        - hyperspectral_image: Input cube (rows, cols, bands); may be a memory map
+        - names: Index names (or a single name)
+        - out: Optional preallocated (rows, cols, len(names)) output
+        - dtype: Output dtype (default: float32 for float32 cubes, float64 otherwise)
+        - tile_rows: Rows per tile (default: about 64k pixels per tile)
+
+        Returns:
+        - Stacked index maps, shape (rows, cols, len(names))
+        """
+        if isinstance(names, str):
+            names = [names]
+        indices = [self.get(name) for name in names]
+
+        rows, cols, bands = hyperspectral_image.shape
+        needed = max((index.min_bands for index in indices), default=0)
+        if bands < needed:
+            raise ValueError(f"Not enough spectral bands for index: need {needed}, got {bands}")
+
+        if out is None:
+            if dtype is None:
+                dtype = np.float32 if hyperspectral_image.dtype == np.float32 else np.float64
+            out = np.empty((rows, cols, len(indices)), dtype=dtype)
+        if tile_rows is None:
+            tile_rows = max(1, _TILE_PIXELS // max(cols, 1))
+
+        # Temporaries are allocated once and reused by every tile and index
+        n_registers = max((index.n_registers for index in indices), default=0)
+        registers = [np.empty((min(tile_rows, rows), cols), dtype=out.dtype) for _ in range(n_registers)]
+
+        for start in range(0, rows, tile_rows):
+            stop = min(start + tile_rows, rows)
+            tile = hyperspectral_image[start:stop]
+            tile_registers = [register[:stop - start] for register in registers]
+            for i, index in enumerate(indices):
+                index.evaluate_tile(tile, out[start:stop, :, i], tile_registers)
+
+        return out
+
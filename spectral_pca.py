@@ -0,0 +1,143 @@
+import numpy as np
+
+# PCA backends accepted by fit_spectral_basis
+PCA_BACKENDS = ('full', 'randomized', 'subsample', 'covariance')
+
+
+class SpectralBasis:
+    def __init__(self, mean, components, explained_variance=None):
+        """
+        Fitted spectral PCA basis
+
+        Parameters:
+        - mean: Per-band mean, shape (bands,)
+        - components: Principal axes, shape (n_components, bands)
+        - explained_variance: Optional variance along each component
+        """
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        self.explained_variance = None if explained_variance is None else np.asarray(explained_variance)
+
+    @property
+    def n_bands(self):
+        return self.components.shape[1]
+
+    def project(self, hyperspectral_image, out=None):
+        """
+        Project a cube onto the basis with a single matrix multiply
+
+        Parameters:
+        - hyperspectral_image: Input cube (rows, cols, bands)
+        - out: Optional preallocated (rows, cols, n_components) output; by default the
+          result is float32 for float32 cubes and float64 otherwise
+
+        Returns:
+        - Projected cube (rows, cols, n_components)
+        """
+        rows, cols, bands = hyperspectral_image.shape
+        if bands != self.n_bands:
+            raise ValueError(f"Basis was fitted on {self.n_bands} bands, got {bands}")
+
+        n_components = self.components.shape[0]
+        if out is None:
+            dtype = np.float32 if hyperspectral_image.dtype == np.float32 else np.float64
+            out = np.empty((rows, cols, n_components), dtype=dtype)
+        components = self.components.astype(out.dtype, copy=False)
+
+        # (X - mean) @ W.T == X @ W.T - mean @ W.T, which avoids centering a copy of X
+        np.matmul(hyperspectral_image.reshape(rows * cols, bands), components.T,
+                  out=out.reshape(rows * cols, n_components))
+        out -= (self.mean @ self.components.T).astype(out.dtype)
+        return out
+
+    def save(self, path):
+        """
+        Save the basis to an .npz file
+        """
+        arrays = {'mean': self.mean, 'components': self.components}
+        if self.explained_variance is not None:
+            arrays['explained_variance'] = self.explained_variance
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a basis saved with save()
+        """
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'],
+                       data['explained_variance'] if 'explained_variance' in data.files else None)
+
+
+def _flip_signs(components):
+    # Deterministic signs: the largest-magnitude loading of each component is positive
+    max_idx = np.argmax(np.abs(components), axis=1)
+    signs = np.sign(components[np.arange(components.shape[0]), max_idx])
+    signs[signs == 0] = 1
+    return components * signs[:, np.newaxis]
+
+
+def _fit_covariance(pixels, n_components, tile_pixels):
+    # Accumulate the (bands x bands) scatter matrix tile by tile, shifted by the
+    # first tile's mean to keep the accumulation numerically stable
+    n_pixels, bands = pixels.shape
+    shift = np.asarray(pixels[:min(tile_pixels, n_pixels)], dtype=np.float64).mean(axis=0)
+
+    total = np.zeros(bands)
+    scatter = np.zeros((bands, bands))
+    for start in range(0, n_pixels, tile_pixels):
+        tile = np.asarray(pixels[start:start + tile_pixels], dtype=np.float64) - shift
+        total += tile.sum(axis=0)
+        scatter += tile.T @ tile
+
+    centered_mean = total / n_pixels
+    covariance = (scatter - n_pixels * np.outer(centered_mean, centered_mean)) / max(n_pixels - 1, 1)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return centered_mean + shift, eigenvectors[:, order].T, eigenvalues[order]
+
+
+def fit_spectral_basis(hyperspectral_image, n_components=3, method='full', sample_size=100000,
+                       random_state=0, tile_pixels=65536):
+    """
+    Fit a spectral PCA basis with a choice of backend
+
+    Parameters:
+    - hyperspectral_image: Input cube (rows, cols, bands)
+    - n_components: Number of principal components
+    - method: 'full' (exact sklearn PCA), 'randomized' (randomized SVD),
+      'subsample' (exact SVD of a random pixel subsample) or 'covariance'
+      (eigendecomposition of a bands x bands covariance accumulated over tiles)
+    - sample_size: Number of pixels used by the 'subsample' backend
+    - random_state: Seed for the randomized and subsample backends
+    - tile_pixels: Pixels per tile for the covariance accumulation
+
+    Returns:
+    - SpectralBasis
+    """
+    rows, cols, bands = hyperspectral_image.shape
+    pixels = hyperspectral_image.reshape(rows * cols, bands)
+
+    if method in ('full', 'randomized'):
+        from sklearn.decomposition import PCA
+        pca = PCA(n_components=n_components, svd_solver=method if method == 'randomized' else 'auto',
+                  random_state=random_state)
+        pca.fit(pixels)
+        return SpectralBasis(pca.mean_, pca.components_, pca.explained_variance_)
+
+    if method == 'subsample':
+        rng = np.random.default_rng(random_state)
+        if sample_size < len(pixels):
+            pixels = pixels[np.sort(rng.choice(len(pixels), size=sample_size, replace=False))]
+        pixels = np.asarray(pixels, dtype=np.float64)
+        mean = pixels.mean(axis=0)
+        _, singular_values, vt = np.linalg.svd(pixels - mean, full_matrices=False)
+        explained_variance = singular_values[:n_components] ** 2 / max(len(pixels) - 1, 1)
+        return SpectralBasis(mean, _flip_signs(vt[:n_components]), explained_variance)
+
+    if method == 'covariance':
+        mean, components, explained_variance = _fit_covariance(pixels, n_components, tile_pixels)
+        return SpectralBasis(mean, _flip_signs(components), explained_variance)
+
+    raise ValueError(f"Unsupported PCA backend: {method}")